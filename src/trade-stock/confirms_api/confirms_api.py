@@ -1,13 +1,25 @@
 #!/bin/python3
-from flask import Flask, Response
-from flask_api import status
-from trade_parameter_name import TradeParameterName
+"""
+The simulated third-party off-platform exchange that confirms trades, an ASGI app so a worker keeps thousands of
+confirms in flight while they wait, instead of holding a sync worker for each one.
+Each confirm waits for its turn under the task's throughput cap, then for a latency drawn from the latency model.
+Run it with: gunicorn confirms_api:app, gunicorn.conf.py picks the uvicorn worker.
+"""
+import asyncio
+import contextlib
+import os
 import boto3
 import logging
-from pythonjsonlogger import jsonlogger
-import time
 import requests
-import os
+from pythonjsonlogger import jsonlogger
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.middleware import Middleware
+from starlette.routing import Route
+from trade_parameter_name import TradeParameterName
+from exchange_model import ExchangeOverloadedError, ExchangeQueue, LatencyModel
+from prometheus_metrics import EVENTS, QUEUE_DEPTH, QUEUE_WAIT, PrometheusMiddleware, exposition
 
 
 class ConfirmsMaintenanceError(RuntimeError):
@@ -18,7 +30,6 @@ class ConfirmsProcessingException(RuntimeError):
     pass
 
 
-app = Flask(__name__)
 count: int = 0
 
 json_handler = logging.StreamHandler()
@@ -32,84 +43,128 @@ tr = requests.get("{}/task".format(meta_data_uri)).json()
 availability_zone_ = tr['AvailabilityZone']
 d = {'az': availability_zone_}
 
+# CONFIRMS_LATENCY_MODEL fixed (default), lognormal or bimodal, see LatencyModel
+latency_model = LatencyModel(os.environ.get('CONFIRMS_LATENCY_MODEL', 'fixed'),
+                             latency_ms=float(os.environ.get('CONFIRMS_LATENCY_MS', '100')),
+                             sigma=float(os.environ.get('CONFIRMS_LATENCY_SIGMA', '.5')),
+                             slow_latency_ms=float(os.environ.get('CONFIRMS_SLOW_LATENCY_MS', '1000')),
+                             slow_fraction=float(os.environ.get('CONFIRMS_SLOW_FRACTION', '.05')))
+# CONFIRMS_MAX_RATE confirms per second and CONFIRMS_MAX_QUEUE waiting confirms are per task, each worker
+# takes its share; gunicorn.conf.py sets WEB_CONCURRENCY to the worker count
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+exchange_queue = ExchangeQueue(max_rate=float(os.environ.get('CONFIRMS_MAX_RATE', '0')) / workers,
+                               max_queue=max(1, int(os.environ.get('CONFIRMS_MAX_QUEUE', '1000')) // workers),
+                               on_depth=QUEUE_DEPTH.set)
 
-def get_exchange_status(request_count: int, force: bool = False) -> str:
-    """
-    Get exchange status is a fault injection for the simulated 3rd party off-platform confirms service.
-    When the exchange status is not OPEN, the service will hard fail.
-    Test full outages with circuit breakers and graceful degradation.
-    """
-    global exchange_status
-    if force or request_count % 10 == 0:
-        ssm_client = boto3.client('ssm')
-        exchange_status = ssm_client.get_parameter(
-            Name=TradeParameterName.TRADE_CONFIRMS_EXCHANGE_STATUS.value)['Parameter']['Value']
-    return exchange_status
+exchange_status = None
+glitch_factor = None
 
 
-def get_exchange_glitch_factor(request_count: int, force: bool = False) -> str:
+def get_exchange_parameters() -> None:
     """
-    Get glitch_factor is a fault injection for the simulated third-party off-platform confirms service.
-    When the glitch_factor is greater than 0, the service will return intermittent errors, or gray failures.
+    Get the exchange status and glitch factor, the fault injections for the simulated 3rd party off-platform
+    confirms service, with one GetParameters call.
+    When the exchange status is not AVAILABLE, the service will hard fail.
+    Test full outages with circuit breakers and graceful degradation.
+    When the glitch_factor is ON, the service will return intermittent errors, or gray failures.
     Test non-deterministic/intermittent error behavior like network issues, impaired instances, and resource exhaustion.
     """
-    global glitch_factor
-    if force or request_count % 10 == 0:
-        ssm_client = boto3.client('ssm')
-        glitch_factor = ssm_client.get_parameter(
-            Name=TradeParameterName.TRADE_CONFIRMS_GLITCH_FACTOR.value)['Parameter']['Value']
-    return glitch_factor
-
-
-exchange_status = get_exchange_status(0, True)
-glitch_factor = get_exchange_glitch_factor(0, True)
-
-
-@app.route("/")
-def health():
+    global exchange_status, glitch_factor
+    ssm_client = boto3.client('ssm')
+    parameters = {parameter['Name']: parameter['Value'] for parameter in ssm_client.get_parameters(
+        Names=[TradeParameterName.TRADE_CONFIRMS_EXCHANGE_STATUS.value,
+               TradeParameterName.TRADE_CONFIRMS_GLITCH_FACTOR.value])['Parameters']}
+    exchange_status = parameters[TradeParameterName.TRADE_CONFIRMS_EXCHANGE_STATUS.value]
+    glitch_factor = parameters[TradeParameterName.TRADE_CONFIRMS_GLITCH_FACTOR.value]
+
+
+async def refresh_exchange_parameters(interval: float) -> None:
+    """Refresh the fault injections every interval seconds off the event loop, so no confirm waits on SSM."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(get_exchange_parameters)
+        except Exception as e:
+            logger.warning("Refreshing the exchange status failed, keeping {} and {}: {}".format(
+                exchange_status, glitch_factor, e), extra=d)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await asyncio.to_thread(get_exchange_parameters)
+    refresher = asyncio.create_task(
+        refresh_exchange_parameters(float(os.environ.get('EXCHANGE_STATUS_REFRESH_INTERVAL', '5'))))
+    logger.info("Started Confirms ASGI app, latency {}, up to {} confirms per second and {} queued per worker".format(
+        latency_model, exchange_queue.max_rate or "unlimited", exchange_queue.max_queue), extra=d)
+    yield
+    refresher.cancel()
+
+
+async def health(request: Request) -> Response:
     """
-    A simple health check for the load balancers that indicates Flask application is up and running.
+    A simple health check for the load balancers that indicates the ASGI application is up and running.
     """
     logger.info("Call to / it's OK", extra=d)
-    return Response(response="OK", status=status.HTTP_200_OK)
+    return PlainTextResponse("OK")
 
 
-@app.route("/exchange-health/")
-def exchange_health():
+async def exchange_health(request: Request) -> Response:
     """
     A deep health check indicates if the exchange is open for trading running and running normally.
     """
     response_message = "Exchange is {} and glitch factor is {}.".format(exchange_status, glitch_factor)
     available = exchange_status == "AVAILABLE" or glitch_factor == "OFF"
-    response_status = status.HTTP_200_OK if available else status.HTTP_503_SERVICE_UNAVAILABLE
     logger.info("Call to /exchange_health/ response is {}".format(response_message), extra=d)
-    return Response(response_message, status=response_status, mimetype="text/plain")
+    return PlainTextResponse(response_message, status_code=200 if available else 503)
 
 
-@app.route("/confirm-trade/", methods=["POST", "GET", "PUT"])
-def confirm_trade():
+async def confirm_trade(request: Request) -> Response:
     """
     Simulated placing a trade order with a third-party off-platform exchange.
-    Demonstrates glitches and outages for resilience chaos testing.
+    Demonstrates glitches and outages for resilience chaos testing, faults are answered right away.
     """
     global count
     count += 1
+    await request.body()
     try:
-        if get_exchange_status(count) != "AVAILABLE":
+        if exchange_status != "AVAILABLE":
             raise ConfirmsMaintenanceError("ConfirmsMaintenanceError: Exchange is not available, come back later!")
-        if get_exchange_glitch_factor(count) == "ON" and count % 3 == 0:
+        if glitch_factor == "ON" and count % 3 == 0:
             raise ConfirmsProcessingException("ConfirmsProcessingException: Processing error, please try again...")
+        QUEUE_WAIT.observe(await exchange_queue.wait_turn())
     except ConfirmsMaintenanceError as e:
+        EVENTS.labels("ConfirmsMaintenanceError").inc()
         logger.error("ConfirmsMaintenanceError:  Exchange status: {}".format(exchange_status), extra=d)
-        return Response(e.__str__(), status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return PlainTextResponse(e.__str__(), status_code=503)
     except ConfirmsProcessingException as e:
+        EVENTS.labels("ConfirmsProcessingException").inc()
         logger.error("ConfirmsProcessingException: glitch_factor is: {}".format(glitch_factor), extra=d)
-        return Response(e.__str__(), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    time.sleep(.1)  # delay to simulate doing some work
+        return PlainTextResponse(e.__str__(), status_code=500)
+    except ExchangeOverloadedError as e:
+        # retried by the order service like any 5xx, it does not open the circuit as maintenance does
+        EVENTS.labels("ConfirmsOverloaded").inc()
+        return PlainTextResponse("ConfirmsOverloadedError: {}".format(e), status_code=503)
+    await asyncio.sleep(latency_model.sample())  # the exchange doing some work
+
+    return PlainTextResponse("Trade Confirmed")
+
+
+async def prometheus_metrics(request: Request) -> Response:
+    """Prometheus exposition of the metrics of every worker of this task."""
+    body, content_type = await asyncio.to_thread(exposition)
+    return Response(body, media_type=content_type)
 
-    return Response("Trade Confirmed", status=status.HTTP_200_OK)
 
+routes = [
+    Route("/", health, methods=["GET"]),
+    Route("/exchange-health/", exchange_health, methods=["GET"]),
+    Route("/confirm-trade/", confirm_trade, methods=["POST", "GET", "PUT"]),
+    Route("/metrics", prometheus_metrics, methods=["GET"]),
+]
+app = Starlette(routes=routes,
+                middleware=[Middleware(PrometheusMiddleware, routes={route.path for route in routes})],
+                lifespan=lifespan)
 
 if __name__ == "__main__":
-    app.run(debug=False, host="0.0.0.0", port=80)
-    logger.info("Started Confirms Flask app", extra=d)
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=80)
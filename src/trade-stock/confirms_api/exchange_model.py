@@ -0,0 +1,84 @@
+import asyncio
+import math
+import random
+
+
+class ExchangeOverloadedError(RuntimeError):
+    pass
+
+
+class LatencyModel:
+    """
+    How long the exchange takes to confirm a trade once it starts on it, in seconds.
+    fixed is always latency_ms, lognormal has a median of latency_ms and a spread of sigma, and bimodal is lognormal
+    around latency_ms except for slow_fraction of confirms, lognormal around slow_latency_ms, such as an exchange
+    whose slow path hits a backing store.
+    """
+    KINDS = ("fixed", "lognormal", "bimodal")
+
+    def __init__(self, kind: str = "fixed", latency_ms: float = 100, sigma: float = .5,
+                 slow_latency_ms: float = 1000, slow_fraction: float = .05):
+        if kind not in self.KINDS:
+            raise ValueError("latency model must be one of {}, not {}".format(", ".join(self.KINDS), kind))
+        self.kind = kind
+        self.latency_ms = latency_ms
+        self.sigma = sigma
+        self.slow_latency_ms = slow_latency_ms
+        self.slow_fraction = slow_fraction
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.latency_ms / 1000
+        median_ms = self.latency_ms
+        if self.kind == "bimodal" and random.random() < self.slow_fraction:
+            median_ms = self.slow_latency_ms
+        return random.lognormvariate(math.log(median_ms), self.sigma) / 1000
+
+    def __repr__(self) -> str:
+        if self.kind == "fixed":
+            return "fixed {} ms".format(self.latency_ms)
+        if self.kind == "lognormal":
+            return "lognormal median {} ms sigma {}".format(self.latency_ms, self.sigma)
+        return "bimodal {} ms and {} ms for {:.0%}, sigma {}".format(self.latency_ms, self.slow_latency_ms,
+                                                                    self.slow_fraction, self.sigma)
+
+
+class ExchangeQueue:
+    """
+    The exchange's order queue. The exchange starts at most max_rate confirms per second, 0 for no limit, in arrival
+    order, and a confirm waits in the queue for its turn; when max_queue confirms are already waiting, a new one is
+    refused with ExchangeOverloadedError instead. Turns are handed out on a virtual clock, so waiting costs a sleep
+    and no polling, and the depth is the number of confirms waiting right now, reported to on_depth as it changes.
+    Not thread-safe, use it from one event loop.
+    """
+
+    def __init__(self, max_rate: float = 0, max_queue: int = 1000, on_depth=None):
+        self.max_rate = max_rate
+        self.max_queue = max_queue
+        self.on_depth = on_depth
+        self.depth = 0
+        self._next_start = 0.0
+
+    def _set_depth(self, depth: int) -> None:
+        self.depth = depth
+        if self.on_depth is not None:
+            self.on_depth(depth)
+
+    async def wait_turn(self) -> float:
+        """Wait for this confirm's turn and return how long it waited in seconds."""
+        if self.max_rate <= 0:
+            return 0.0
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_start)
+        if start <= now:
+            self._next_start = now + 1 / self.max_rate
+            return 0.0
+        if self.depth >= self.max_queue:
+            raise ExchangeOverloadedError("{} confirms are already queued".format(self.depth))
+        self._next_start = start + 1 / self.max_rate
+        self._set_depth(self.depth + 1)
+        try:
+            await asyncio.sleep(start - now)
+        finally:
+            self._set_depth(self.depth - 1)
+        return start - now
@@ -0,0 +1,95 @@
+# gunicorn reads ./gunicorn.conf.py on start, settings on the command line take precedence
+import json
+import math
+import os
+import shutil
+import urllib.request
+
+# every worker writes its Prometheus samples to this directory and /metrics aggregates them,
+# it is cleared when the server starts so counters restart with it
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _task_limits() -> dict:
+    """The task CPU and memory limits from the ECS task metadata, which Fargate sets when the cgroup does not."""
+    meta_data_uri = os.environ.get("ECS_CONTAINER_METADATA_URI_V4")
+    if not meta_data_uri:
+        return {}
+    try:
+        with urllib.request.urlopen("{}/task".format(meta_data_uri), timeout=1) as response:
+            return json.load(response).get("Limits", {})
+    except Exception:
+        return {}
+
+
+def cgroup_limits() -> tuple:
+    """
+    The CPUs and MiB of memory this container may use, from the cgroup v2 or v1 limits, then the ECS task limits,
+    then the whole host. GUNICORN_CPUS and GUNICORN_MEMORY_MB override them.
+    """
+    cpus = memory_mb = None
+    quota, _, period = _read("/sys/fs/cgroup/cpu.max").partition(" ")
+    if not quota:
+        quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota.lstrip("-").isdigit() and int(quota) > 0 and period.isdigit():
+        cpus = int(quota) / int(period)
+    limit = _read("/sys/fs/cgroup/memory.max") or _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    # cgroup v1 reports no limit as a number close to 2 ** 63
+    if limit.isdigit() and int(limit) < 1 << 60:
+        memory_mb = int(limit) // (1 << 20)
+    if cpus is None or memory_mb is None:
+        task_limits = _task_limits()
+        cpus = cpus or task_limits.get("CPU")
+        memory_mb = memory_mb or task_limits.get("Memory")
+    cpus = float(os.environ.get("GUNICORN_CPUS", cpus or os.cpu_count() or 1))
+    memory_mb = int(os.environ.get("GUNICORN_MEMORY_MB",
+                                   memory_mb or os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1 << 20)))
+    return cpus, memory_mb
+
+
+# GUNICORN_PROFILE picks the worker model, the app is ASGI so there is one:
+#   uvicorn - a worker per CPU, each an event loop keeping every confirm of the task's share in flight, the default
+# capped by memory, GUNICORN_WORKER_MEMORY_MB per worker within 80% of the limit, GUNICORN_WORKERS overrides the
+# computed count
+profile = os.environ.get("GUNICORN_PROFILE", "uvicorn")
+cpus, memory_mb = cgroup_limits()
+memory_workers = max(1, int(memory_mb * .8) // int(os.environ.get("GUNICORN_WORKER_MEMORY_MB", "80")))
+if profile == "uvicorn":
+    worker_class = "uvicorn.workers.UvicornWorker"
+    workers = min(math.ceil(cpus), memory_workers)
+else:
+    raise ValueError("GUNICORN_PROFILE must be uvicorn, not {}".format(profile))
+workers = int(os.environ.get("GUNICORN_WORKERS", workers))
+# the throughput cap and queue of the task are split between the workers, see confirms_api.py
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+# GUNICORN_PRELOAD imports the app once in the master and forks the workers from it, so a worker starts in
+# milliseconds and shares the master's memory pages. The app starts no threads on import, its event loop and
+# exchange status refresher start in each worker with the ASGI lifespan.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false") == "true"
+
+# recycle a worker after GUNICORN_MAX_REQUESTS requests, off by default, with up to GUNICORN_MAX_REQUESTS_JITTER
+# more (default a tenth) so the workers of a task do not all restart at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", max_requests // 10))
+
+
+def when_ready(server):
+    server.log.info("Profile %s: %s %s workers for %.2f CPUs and %s MiB, preload %s",
+                    profile, workers, worker_class, cpus, memory_mb, preload_app)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges, such as requests in flight, of a worker that exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,94 @@
+import math
+import threading
+import time
+
+
+class GradientLimiter:
+    """
+    An adaptive concurrency limit, in the style of the Gradient2 limit from Netflix concurrency-limits.
+    A short and a long exponentially weighted average of request latency are compared: while recent requests are no
+    slower than the long term average, allowing for tolerance, the limit grows by a small queue allowance, and as
+    latency climbs the limit shrinks in proportion. A server error shrinks the limit multiplicatively.
+    """
+
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64, tolerance: float = 1.5,
+                 smoothing: float = 0.2, error_backoff: float = 0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.error_backoff = error_backoff
+        self.in_flight = 0
+        self.shed = 0
+        self._short_latency = None
+        self._long_latency = None
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, failed: bool = False) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.limit = max(self.min_limit, self.limit * self.error_backoff)
+                return
+            if self._short_latency is None:
+                self._short_latency = self._long_latency = latency
+            self._short_latency += (latency - self._short_latency) * 0.5
+            self._long_latency += (latency - self._long_latency) * 0.01
+            # let the long term average follow a lasting drop in latency, as after recovering from overload
+            if self._long_latency > self._short_latency * 2:
+                self._long_latency *= 0.95
+            gradient = max(0.5, min(1.0, self.tolerance * self._long_latency / self._short_latency))
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            self.limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+            self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+
+class AdmissionControl:
+    """
+    WSGI middleware that answers 503 with Retry-After straight away once the limiter is at its limit, instead of
+    letting requests queue until the gunicorn timeout kills the worker. Only paths in limited_paths are counted
+    and shed, so health checks and /region-az/ are always answered.
+    The limit applies to the requests one worker process serves at once, so shedding needs a worker with threads,
+    a sync worker only ever has one request in flight.
+    """
+
+    def __init__(self, app, limiter: GradientLimiter, limited_paths: set, retry_after: int = 1, on_shed=None):
+        self.app = app
+        self.limiter = limiter
+        self.limited_paths = limited_paths
+        self.retry_after = str(retry_after)
+        self.on_shed = on_shed
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") not in self.limited_paths:
+            return self.app(environ, start_response)
+        if not self.limiter.try_acquire():
+            if self.on_shed is not None:
+                self.on_shed(environ.get("PATH_INFO"))
+            start_response("503 Service Unavailable", [("Content-Type", "text/plain"),
+                                                       ("Retry-After", self.retry_after)])
+            return [b"Over capacity, retry later"]
+
+        status = []
+
+        def recording_start_response(response_status, headers, exc_info=None):
+            status.append(response_status)
+            return start_response(response_status, headers, exc_info)
+
+        start = time.monotonic()
+        failed = True
+        try:
+            response = self.app(environ, recording_start_response)
+            failed = not status or status[0].startswith("5")
+            return response
+        finally:
+            self.limiter.release(time.monotonic() - start, failed)
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import update
+from sqlalchemy import values, column, Integer, Float
+from sqlalchemy.orm import Session
+from data_objects import Customer
+
+
+class CustomerLedger:
+    """
+    Customer cash balances, reserved and released with single statement autocommit updates on the writer.
+    A reservation is one UPDATE ... WHERE balance >= cost RETURNING balance, so the check and the debit are one
+    round trip and concurrent orders for the same customer cannot take the balance below zero.
+    Balances seen by this process, from the reader or returned by a reservation, are kept in a bounded LRU cache
+    for ttl seconds. The cache only rejects orders early, a reservation is still made on the writer.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._balances = OrderedDict()
+        self._lock = threading.Lock()
+
+    def balance(self, customer: Customer) -> float:
+        """The cached balance of a customer, read through from the customer row when missing or expired."""
+        with self._lock:
+            entry = self._balances.get(customer.id)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self._balances.move_to_end(customer.id)
+                return entry[0]
+        return self._put(customer.id, customer.balance)
+
+    def _put(self, customer_id: int, balance: float) -> float:
+        with self._lock:
+            self._balances[customer_id] = (balance, time.monotonic())
+            self._balances.move_to_end(customer_id)
+            while len(self._balances) > self.max_size:
+                self._balances.popitem(last=False)
+        return balance
+
+    def invalidate(self, customer_id: int) -> None:
+        with self._lock:
+            self._balances.pop(customer_id, None)
+
+    @staticmethod
+    def _autocommit(session: Session) -> None:
+        session.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
+
+    def reserve(self, session: Session, customer_id: int, cost: float) -> bool:
+        """Debit cost from the balance if it covers it, returns False and debits nothing otherwise."""
+        self._autocommit(session)
+        statement = update(Customer) \
+            .where(Customer.id == customer_id, Customer.balance >= cost) \
+            .values(balance=Customer.balance - cost) \
+            .returning(Customer.balance) \
+            .execution_options(synchronize_session=False)
+        remaining = session.execute(statement).scalar_one_or_none()
+        session.commit()
+        if remaining is None:
+            self.invalidate(customer_id)
+            return False
+        self._put(customer_id, remaining)
+        return True
+
+    def record_reservation(self, customer_id: int, remaining) -> None:
+        """Cache the balance left by a reservation made outside the ledger, None when nothing was reserved."""
+        if remaining is None:
+            self.invalidate(customer_id)
+        else:
+            self._put(customer_id, remaining)
+
+    def release(self, session: Session, customer_id: int, cost: float) -> None:
+        """Credit back a reservation for an order that was not filled."""
+        self._autocommit(session)
+        statement = update(Customer) \
+            .where(Customer.id == customer_id) \
+            .values(balance=Customer.balance + cost) \
+            .returning(Customer.balance) \
+            .execution_options(synchronize_session=False)
+        remaining = session.execute(statement).scalar_one_or_none()
+        session.commit()
+        if remaining is not None:
+            self._put(customer_id, remaining)
+
+    def _update_many(self, session: Session, costs: dict, debit: bool, autocommit: bool = True) -> dict:
+        if autocommit:
+            self._autocommit(session)
+        amounts = values(column("customer_id", Integer), column("cost", Float), name="amounts") \
+            .data(list(costs.items()))
+        statement = update(Customer).where(Customer.id == amounts.c.customer_id)
+        if debit:
+            statement = statement.where(Customer.balance >= amounts.c.cost) \
+                .values(balance=Customer.balance - amounts.c.cost)
+        else:
+            statement = statement.values(balance=Customer.balance + amounts.c.cost)
+        statement = statement.returning(Customer.id, Customer.balance).execution_options(synchronize_session=False)
+        remaining = dict(session.execute(statement).all())
+        if autocommit:
+            session.commit()
+        for customer_id in costs:
+            # a balance from a transaction that is not committed yet is not cached
+            if autocommit and customer_id in remaining:
+                self._put(customer_id, remaining[customer_id])
+            else:
+                self.invalidate(customer_id)
+        return remaining
+
+    def reserve_many(self, session: Session, costs: dict, autocommit: bool = True) -> set:
+        """
+        Reserve the total cost of a batch for each customer with one UPDATE ... FROM (VALUES ...) RETURNING,
+        all or nothing per customer. Returns the ids of the customers whose reservation was made.
+        With autocommit False the update joins the transaction of the session, which the caller commits.
+        """
+        return set(self._update_many(session, costs, debit=True, autocommit=autocommit)) if costs else set()
+
+    def release_many(self, session: Session, costs: dict, autocommit: bool = True) -> None:
+        """
+        Credit back reservations for several customers with one UPDATE ... FROM (VALUES ...).
+        With autocommit False the update joins the transaction of the session, which the caller commits.
+        """
+        if costs:
+            self._update_many(session, costs, debit=False, autocommit=autocommit)
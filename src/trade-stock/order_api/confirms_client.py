@@ -0,0 +1,78 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class ConfirmsClient:
+    """
+    A shared, connection-pooled HTTP client for the trade confirms service.
+    Connections to the confirms load balancer are kept alive and reused across trades, so an order only pays for a
+    TCP handshake when the pool has no idle connection. Connect and read timeouts are separate, so a slow handshake
+    fails fast without shortening the time the exchange has to answer.
+    """
+
+    def __init__(self, endpoint: str, pool_size: int = 10, connect_timeout: float = .1, read_timeout: float = .3,
+                 keep_alive: bool = True):
+        self.base_url = "http://{}".format(endpoint)
+        self.timeout = (connect_timeout, read_timeout)
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        client = self
+
+        # count TCP connects rather than pooled connection objects, urllib3 reconnects a dropped connection in place
+        class CountingHTTPConnection(HTTPConnection):
+            def connect(self):
+                client._connection_opened()
+                return super().connect()
+
+        class CountingHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                client._connection_opened()
+                return super().connect()
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingHTTPConnection
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = CountingHTTPSConnection
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        adapter.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool,
+                                                      "https": CountingHTTPSConnectionPool}
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def _connection_opened(self) -> None:
+        self._local.opened = True
+        with self._lock:
+            self.connections_opened += 1
+
+    def request(self, method: str, path: str, timeout=None, **kwargs) -> requests.Response:
+        self._local.opened = False
+        try:
+            return self.session.request(method, self.base_url + path, timeout=timeout or self.timeout, **kwargs)
+        finally:
+            with self._lock:
+                self.requests += 1
+                if not self._local.opened:
+                    self.connections_reused += 1
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "connections_opened": self.connections_opened,
+                    "connections_reused": self.connections_reused}
@@ -0,0 +1,140 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class RetryBudget:
+    """
+    A per-process token bucket that caps retries and hedges at a fraction of calls, so retrying cannot multiply the
+    load on a struggling dependency. Every call deposits ratio tokens, every retry or hedge withdraws one, and a
+    small time based allowance keeps a trickle of retries available when traffic is low.
+    """
+
+    def __init__(self, ratio: float = .1, min_per_second: float = 1.0, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, amount: float) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + amount + (now - self._last) * self.min_per_second)
+        self._last = now
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyTracker:
+    """Latency of the most recent successful calls, for the hedge delay percentile."""
+
+    def __init__(self, size: int = 256, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percentile: float):
+        """The latency percentile in seconds, None until there are min_samples samples."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class RetryingCaller:
+    """
+    Calls a dependency with retries and optional hedging inside a deadline.
+    A failed attempt is retried when should_retry(error) is true, there is a retry token and the backoff plus one
+    more attempt still fit in the deadline. Backoff is exponential with full jitter, a random delay between 0 and
+    base_delay * 2 ** attempt, capped at max_delay.
+    With hedging, an attempt still running after the hedge percentile of recent latency, at least
+    hedge_min_delay, is raced against a second identical attempt, which also needs a token, and the first success
+    wins. metrics counts ConfirmsRetry, ConfirmsRetryBudgetExhausted, ConfirmsHedge and ConfirmsHedgeWon.
+    """
+
+    def __init__(self, budget: RetryBudget, should_retry, metrics, max_attempts: int = 3, base_delay: float = .025,
+                 max_delay: float = .25, attempt_timeout: float = .4, deadline: float = 1.0, hedging: bool = False,
+                 hedge_percentile: float = 95, hedge_min_delay: float = .05, hedge_workers: int = 10):
+        self.budget = budget
+        self.should_retry = should_retry
+        self.metrics = metrics
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.latencies = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge") if hedging else None
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func):
+        """Call func, a zero argument callable for one attempt, returns its first successful result."""
+        deadline = time.monotonic() + self.deadline
+        self.budget.deposit()
+        for attempt in range(self.max_attempts):
+            try:
+                return self._attempt(func)
+            except Exception as e:
+                delay = self.backoff(attempt)
+                if not self.should_retry(e) or attempt + 1 >= self.max_attempts \
+                        or time.monotonic() + delay + self.attempt_timeout > deadline:
+                    raise
+                if not self.budget.withdraw():
+                    self.metrics.increment("ConfirmsRetryBudgetExhausted")
+                    raise
+                self.metrics.increment("ConfirmsRetry")
+                time.sleep(delay)
+
+    def _timed(self, func):
+        start = time.monotonic()
+        result = func()
+        self.latencies.record(time.monotonic() - start)
+        return result
+
+    def _attempt(self, func):
+        if not self.hedging:
+            return self._timed(func)
+        hedge_delay = self.latencies.percentile(self.hedge_percentile)
+        first = self._executor.submit(self._timed, func)
+        try:
+            return first.result(timeout=None if hedge_delay is None else max(hedge_delay, self.hedge_min_delay))
+        except FutureTimeoutError:
+            pass
+        if not self.budget.withdraw():
+            return first.result()
+        self.metrics.increment("ConfirmsHedge")
+        hedge = self._executor.submit(self._timed, func)
+        pending = {first, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.metrics.increment("ConfirmsHedgeWon")
+                    return future.result()
+        # both attempts failed, report the error of the original one
+        return first.result()
@@ -1,5 +1,6 @@
 from datetime import datetime
 import enum
+from operator import attrgetter
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -8,7 +9,21 @@ from sqlalchemy import String
 
 
 class Base(DeclarativeBase):
-    pass
+
+    def as_dict(self):
+        # the column names of each model are looked up once, not walked on every call
+        getter = _column_getters.get(type(self))
+        if getter is None:
+            names = tuple(c.name for c in self.__table__.columns)
+            getter = _column_getters.setdefault(type(self), (names, attrgetter(*names)))
+        names, get_values = getter
+        return dict(zip(names, get_values(self)))
+
+    def __str__(self):
+        return str(self.as_dict())
+
+
+_column_getters = {}
 
 
 class Customer(Base):
@@ -17,12 +32,10 @@ class Customer(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     first_name: Mapped[str] = mapped_column(String(250))
     last_name: Mapped[str] = mapped_column(String(250))
+    balance: Mapped[float]
     created_on: Mapped[datetime]
     updated_on: Mapped[datetime]
 
-    def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-
 
 class Symbol(Base):
     __tablename__ = "symbol"
@@ -37,9 +50,6 @@ class Symbol(Base):
     created_on: Mapped[datetime]
     updated_on: Mapped[datetime]
 
-    def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
-
 
 class TransactionType(str, enum.Enum):
     buy = "buy"
@@ -65,6 +75,3 @@ class Activity(Base):
     status: Mapped[TradeState] = mapped_column(name="status")
     current_price: Mapped[float]
     share_count: Mapped[float]
-
-    def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
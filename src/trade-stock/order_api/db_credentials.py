@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+
+class RotatingCredentials:
+    """
+    Supplies database credentials to every new connection from the Secrets Manager cache through the SQLAlchemy
+    do_connect event, so a rotated password reaches new connections without rebuilding the engine.
+    The multi-user rotation alternates between two users, and the previous user stays valid until the next rotation,
+    so connections that are already open keep working and can drain.
+    get_secrets_cache returns the SecretCache, so the cache itself can still be created lazily.
+    """
+
+    def __init__(self, get_secrets_cache, secret_id: str, min_refresh_interval: float = 5.0):
+        self.get_secrets_cache = get_secrets_cache
+        self.secret_id = secret_id
+        self.min_refresh_interval = min_refresh_interval
+        self._lock = threading.Lock()
+        self._last_refresh = 0.0
+        self._secret_string = None
+        self._secret = None
+
+    def current(self) -> dict:
+        """The parsed secret, parsing again only when the cached secret string changed."""
+        secret_string = self.get_secrets_cache().get_secret_string(secret_id=self.secret_id)
+        if secret_string != self._secret_string:
+            self._secret, self._secret_string = json.loads(secret_string), secret_string
+        return self._secret
+
+    def version(self) -> tuple:
+        secret = self.current()
+        return secret['username'], secret['password']
+
+    def inject(self, dialect, conn_rec, cargs, cparams) -> None:
+        """do_connect listener, connects as the current user with the current password."""
+        secret = self.current()
+        cparams['user'] = secret['username']
+        cparams['password'] = secret['password']
+
+    def refresh(self) -> bool:
+        """
+        Force a refresh from Secrets Manager after a failed connection, at most once per min_refresh_interval
+        so a burst of failures does not become a burst of Secrets Manager calls. Returns True if the credentials
+        changed.
+        """
+        with self._lock:
+            if time.monotonic() - self._last_refresh < self.min_refresh_interval:
+                return False
+            self._last_refresh = time.monotonic()
+            before = self.version()
+            self.get_secrets_cache().refresh_secret_now(self.secret_id)
+            return self.version() != before
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import boto3
+from sqlalchemy.pool import QueuePool
+
+
+class PoolTelemetry:
+    """
+    Collects connection pool statistics for one engine: how long checkouts waited for a connection,
+    and on each sample, connections in use, idle and in overflow. Checkout waits are also recorded in histogram,
+    a RollingHistogram, when one is given, and passed to on_wait.
+    """
+
+    def __init__(self, name: str, histogram=None, on_wait=None):
+        self.name = name
+        self.histogram = histogram
+        self.on_wait = on_wait
+        self._lock = threading.Lock()
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self.pool_class = self._timed_pool_class()
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self._waits += 1
+            self._wait_total += seconds
+            self._wait_max = max(self._wait_max, seconds)
+        if self.histogram is not None:
+            self.histogram.record(seconds)
+        if self.on_wait is not None:
+            self.on_wait(seconds)
+
+    def drain_waits(self) -> tuple:
+        """Returns (checkouts, average wait ms, max wait ms) since the last drain."""
+        with self._lock:
+            waits, total, longest = self._waits, self._wait_total, self._wait_max
+            self._waits, self._wait_total, self._wait_max = 0, 0.0, 0.0
+        return waits, (total / waits * 1000) if waits else 0.0, longest * 1000
+
+    def _timed_pool_class(self):
+        """
+        A QueuePool subclass that times every checkout, including the wait for a free connection.
+        Engine.dispose() recreates the pool from its class, so the timing survives a pool refresh.
+        """
+        telemetry = self
+
+        class TimedQueuePool(QueuePool):
+            def connect(self):
+                start = time.perf_counter()
+                try:
+                    return super().connect()
+                finally:
+                    telemetry.record_wait(time.perf_counter() - start)
+
+        return TimedQueuePool
+
+    def publish(self, pool, metrics) -> dict:
+        checkouts, wait_avg, wait_max = self.drain_waits()
+        sample = {"Size": pool.size(), "InUse": pool.checkedout(), "Idle": pool.checkedin(),
+                  "Overflow": max(pool.overflow(), 0), "Checkouts": checkouts}
+        for name, value in sample.items():
+            metrics.gauge("{}Pool{}".format(self.name, name), value)
+        metrics.gauge("{}PoolCheckoutWaitAvg".format(self.name), wait_avg, "Milliseconds")
+        metrics.gauge("{}PoolCheckoutWaitMax".format(self.name), wait_max, "Milliseconds")
+        sample.update({"CheckoutWaitAvg": wait_avg, "CheckoutWaitMax": wait_max})
+        return sample
+
+
+def live_task_count(task_metadata: dict, default: int) -> int:
+    """
+    Number of running tasks in this task's ECS service, falls back to default when the service is unknown.
+    The service name comes from the task metadata or the ECS_SERVICE_NAME environment variable.
+    """
+    service_name = os.environ.get('ECS_SERVICE_NAME', task_metadata.get('ServiceName'))
+    if not service_name or 'Cluster' not in task_metadata:
+        return default
+    ecs_client = boto3.client('ecs')
+    services = ecs_client.describe_services(cluster=task_metadata['Cluster'], services=[service_name])['services']
+    return max(services[0]['runningCount'], 1) if services else default
+
+
+class PoolSizer:
+    """
+    Sizes a per-process connection pool from a global connection budget, such as the database max_connections
+    less reserved slots, shared by every worker process of every live task. Scaling out shrinks each pool instead
+    of running the database out of connection slots. When a process keeps a pool per database instance, such as
+    one per reader, the budget is split evenly between the instances, each pool is sized from its share.
+    """
+
+    def __init__(self, budget: int, workers_per_task: int, max_pool_size: int, tasks: int = 1, instances: int = 1):
+        self.budget = budget
+        self.workers_per_task = max(workers_per_task, 1)
+        self.max_pool_size = max_pool_size
+        self.tasks = max(tasks, 1)
+        self.instances = max(instances, 1)
+
+    def pool_size(self) -> int:
+        return min(max(self.budget // (self.instances * self.tasks * self.workers_per_task), 1),
+                   self.max_pool_size)
+
+
+class PoolMonitor:
+    """
+    Publishes pool telemetry for each engine on a fixed interval from a daemon thread. Every resize_interval it
+    looks up the live task count and calls on_resize(pool name, new size) for each pool whose size changed.
+    pools is a callable returning (telemetry, engine, sizer) for each pool, engine is None until it is created.
+    """
+
+    def __init__(self, pools, task_count, on_resize, metrics, logger, extra: dict,
+                 interval: float = 30.0, resize_interval: float = 300.0):
+        self.pools = pools
+        self.task_count = task_count
+        self.on_resize = on_resize
+        self.metrics = metrics
+        self.logger = logger
+        self.extra = extra
+        self.interval = interval
+        self.resize_interval = resize_interval
+        self._last_resize = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self) -> dict:
+        """Publish telemetry for every engine that exists yet, returns the samples by pool name."""
+        samples = {}
+        for telemetry, engine, _ in self.pools():
+            if engine is not None:
+                samples[telemetry.name] = telemetry.publish(engine.pool, self.metrics)
+        return samples
+
+    def resize(self) -> None:
+        tasks = max(self.task_count(), 1)
+        for telemetry, engine, sizer in self.pools():
+            current = sizer.pool_size()
+            sizer.tasks = tasks
+            target = sizer.pool_size()
+            if target != current:
+                self.logger.info("Resizing {} connection pool from {} to {} for {} tasks".format(
+                    telemetry.name, current, target, tasks), extra=self.extra)
+                if engine is not None:
+                    self.on_resize(telemetry.name, target)
+
+    def start(self) -> None:
+        def run():
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.sample()
+                    if time.monotonic() - self._last_resize >= self.resize_interval:
+                        self._last_resize = time.monotonic()
+                        self.resize()
+                except Exception as e:
+                    self.logger.warning("Connection pool monitor failed: {}".format(e), extra=self.extra)
+
+        self._thread = threading.Thread(target=run, name="pool-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from sqlalchemy.orm import Session
+from data_objects import TradeState
+from repository import OrderRepository
+
+FINAL_STATES = {TradeState.filled, TradeState.rejected, TradeState.aborted}
+
+
+class IdempotentOrders:
+    """
+    Replays the stored outcome of an order whose request_id was already seen, instead of trading it again.
+    Orders in a final state are kept in a bounded, thread-safe LRU cache of request_id to as_dict() results, so a
+    client retry in this process costs no database round trip. A duplicate that arrives while the original is
+    still being processed waits for that execution and returns its result, rather than failing on the unique
+    constraint. Orders placed by other processes are found with stored(), after the insert conflicts.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._orders = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0
+        self.repository = OrderRepository()
+
+    def get(self, request_id: str):
+        """The cached outcome for a request id, or None."""
+        with self._lock:
+            order = self._orders.get(request_id)
+            if order is not None:
+                self._orders.move_to_end(request_id)
+                self.hits += 1
+            return order
+
+    def put(self, order: dict) -> dict:
+        """Cache an order outcome, orders that may still change state are not cached."""
+        if TradeState(order["status"]) in FINAL_STATES:
+            with self._lock:
+                self._orders[order["request_id"]] = order
+                self._orders.move_to_end(order["request_id"])
+                while len(self._orders) > self.max_size:
+                    self._orders.popitem(last=False)
+        return order
+
+    def run(self, request_id: str, place_order, timeout: float = None) -> dict:
+        """
+        Return the cached outcome for request_id, or the result of place_order(), which returns an as_dict().
+        Concurrent calls for the same request id share one call of place_order, errors included.
+        """
+        order = self.get(request_id)
+        if order is not None:
+            return order
+        in_flight, leader = self._join(request_id)
+        if not leader:
+            return in_flight.result(timeout)
+        try:
+            order = self.put(place_order())
+        except BaseException as e:
+            self._settle(request_id, in_flight, error=e)
+            raise
+        self._settle(request_id, in_flight, order)
+        return order
+
+    async def run_async(self, request_id: str, place_order) -> dict:
+        """
+        run() for an asyncio app, place_order is a coroutine function and a duplicate awaits the call in flight
+        instead of blocking the event loop.
+        """
+        order = self.get(request_id)
+        if order is not None:
+            return order
+        in_flight, leader = self._join(request_id)
+        if not leader:
+            return await asyncio.wrap_future(in_flight)
+        try:
+            order = self.put(await place_order())
+        except BaseException as e:
+            self._settle(request_id, in_flight, error=e)
+            raise
+        self._settle(request_id, in_flight, order)
+        return order
+
+    def _join(self, request_id: str) -> tuple:
+        """The call in flight for request_id, and whether this caller started it and has to settle it."""
+        with self._lock:
+            in_flight = self._in_flight.get(request_id)
+            if in_flight is not None:
+                self.coalesced += 1
+                return in_flight, False
+            in_flight = self._in_flight[request_id] = Future()
+            return in_flight, True
+
+    def _settle(self, request_id: str, in_flight: Future, order: dict = None, error: BaseException = None) -> None:
+        if error is None:
+            in_flight.set_result(order)
+        else:
+            in_flight.set_exception(error)
+        with self._lock:
+            del self._in_flight[request_id]
+
+    def stored(self, request_id: str, session: Session):
+        """The order already placed with request_id, read with the unique index, or None."""
+        return self.repository.activity(session, request_id)
+
+    def stored_many(self, request_ids, session: Session) -> list:
+        """The orders already placed with any of request_ids, read with one IN query on the unique index."""
+        return self.repository.activities(session, request_ids) if request_ids else []
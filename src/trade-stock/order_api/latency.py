@@ -0,0 +1,119 @@
+import threading
+import time
+
+
+class LatencyHistogram:
+    """
+    A log-linear latency histogram in the style of HdrHistogram. Values are recorded in microseconds into
+    2 ** precision_bits linear sub-buckets per power of two, so every recorded value is within about
+    1 / 2 ** precision_bits of its bucket, 3% by default, from microseconds to minutes in a few hundred counters.
+    Thread-safe.
+    """
+
+    def __init__(self, precision_bits: int = 5):
+        self.precision_bits = precision_bits
+        self.sub_buckets = 1 << precision_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, micros: int) -> int:
+        shift = max(0, micros.bit_length() - self.precision_bits - 1)
+        return shift * self.sub_buckets + (micros >> shift)
+
+    def _lowest(self, index: int) -> int:
+        """The smallest value, in microseconds, counted in a bucket."""
+        if index < 2 * self.sub_buckets:
+            return index
+        shift = index // self.sub_buckets - 1
+        return (index - shift * self.sub_buckets) << shift
+
+    def _highest(self, index: int) -> int:
+        return self._lowest(index + 1) - 1
+
+    def record(self, seconds: float) -> None:
+        micros = max(0, int(seconds * 1_000_000))
+        index = self._index(micros)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += micros
+            self.min = micros if self.min is None else min(self.min, micros)
+            self.max = max(self.max, micros)
+
+    def merge(self, other: "LatencyHistogram") -> "LatencyHistogram":
+        with other._lock:
+            counts, count, total, low, high = dict(other.counts), other.count, other.total, other.min, other.max
+        with self._lock:
+            for index, bucket_count in counts.items():
+                self.counts[index] = self.counts.get(index, 0) + bucket_count
+            self.count += count
+            self.total += total
+            if low is not None:
+                self.min = low if self.min is None else min(self.min, low)
+            self.max = max(self.max, high)
+        return self
+
+    def percentile(self, percentile: float) -> float:
+        """The value at a percentile in milliseconds, the highest value of its bucket, 0 when empty."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, int(round(self.count * percentile / 100.0)))
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= rank:
+                    return min(self._highest(index), self.max) / 1000.0
+        return self.max / 1000.0
+
+    def as_dict(self) -> dict:
+        """Count, mean, min, max and percentiles in milliseconds, and non empty buckets as [upper ms, count]."""
+        summary = {"count": self.count,
+                   "mean_ms": self.total / self.count / 1000.0 if self.count else 0.0,
+                   "min_ms": (self.min or 0) / 1000.0,
+                   "max_ms": self.max / 1000.0}
+        for percentile in (50, 90, 99, 99.9):
+            summary["p{}_ms".format(str(percentile).replace(".", ""))] = self.percentile(percentile)
+        with self._lock:
+            summary["buckets"] = [[self._highest(index) / 1000.0, self.counts[index]] for index in sorted(self.counts)]
+        return summary
+
+
+class RollingHistogram:
+    """
+    A latency histogram over the last window seconds, kept as slots histograms that each cover window / slots
+    seconds; the oldest slot is dropped as time moves on.
+    """
+
+    def __init__(self, window: float = 60.0, slots: int = 6, precision_bits: int = 5):
+        self.slot_seconds = window / slots
+        self.precision_bits = precision_bits
+        self._slots = [(0, LatencyHistogram(precision_bits)) for _ in range(slots)]
+        self._lock = threading.Lock()
+
+    def _slot(self, epoch: int) -> LatencyHistogram:
+        position = epoch % len(self._slots)
+        with self._lock:
+            slot_epoch, histogram = self._slots[position]
+            if slot_epoch != epoch:
+                histogram = LatencyHistogram(self.precision_bits)
+                self._slots[position] = (epoch, histogram)
+            return histogram
+
+    def record(self, seconds: float) -> None:
+        self._slot(int(time.monotonic() / self.slot_seconds)).record(seconds)
+
+    def snapshot(self) -> LatencyHistogram:
+        """The histogram of the values recorded within the window."""
+        oldest = int(time.monotonic() / self.slot_seconds) - len(self._slots) + 1
+        merged = LatencyHistogram(self.precision_bits)
+        with self._lock:
+            slots = list(self._slots)
+        for slot_epoch, histogram in slots:
+            if slot_epoch >= oldest:
+                merged.merge(histogram)
+        return merged
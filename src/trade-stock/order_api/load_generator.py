@@ -0,0 +1,76 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from latency import LatencyHistogram
+from repository import OrderRepository
+
+SELECT_ONE = text("select 1")
+SLEEP = text("select pg_sleep(:seconds)")
+
+
+class LoadGenerator:
+    """
+    Runs one kind of query against an engine from concurrency threads for duration seconds, and measures each
+    query in two parts: the wait to check a connection out of the pool, and the time on the database once it has
+    one. Comparing the two histograms tells pool queueing apart from database time.
+    Query kinds: select1 is one round trip, sleep holds a connection for sleep seconds with pg_sleep, customer
+    and symbols are the order API lookups, customers by id cycling over 1 to ids.
+    """
+    QUERIES = ("select1", "sleep", "customer", "symbols")
+
+    def __init__(self, max_concurrency: int = 32, max_duration: float = 1.5):
+        self.max_concurrency = max_concurrency
+        self.max_duration = max_duration
+
+    @staticmethod
+    def _statement(query: str, n: int, sleep: float, ids: int) -> tuple:
+        if query == "select1":
+            return SELECT_ONE, {}
+        if query == "sleep":
+            return SLEEP, {"seconds": sleep}
+        if query == "customer":
+            return OrderRepository.CUSTOMER_BY_ID, {"customer_id": n % ids + 1}
+        return OrderRepository.SYMBOLS, {"limit": ids}
+
+    def run(self, engine, query: str, concurrency: int, duration: float, sleep: float = .1, ids: int = 100) -> dict:
+        """Run the load and return the latency, pool wait and query time histograms with error counts."""
+        if query not in self.QUERIES:
+            raise ValueError("query must be one of {}".format(", ".join(self.QUERIES)))
+        concurrency = max(1, min(concurrency, self.max_concurrency))
+        duration = max(0.0, min(duration, self.max_duration))
+        latency, pool_wait, query_time = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        errors = {}
+        lock = threading.Lock()
+        counter = itertools.count()
+
+        def worker(deadline: float) -> None:
+            while time.monotonic() < deadline:
+                statement, parameters = self._statement(query, next(counter), sleep, ids)
+                start = time.perf_counter()
+                try:
+                    with engine.connect() as connection:
+                        checked_out = time.perf_counter()
+                        with Session(bind=connection) as session:
+                            session.execute(statement, parameters).all()
+                        done = time.perf_counter()
+                except Exception as e:
+                    with lock:
+                        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    continue
+                pool_wait.record(checked_out - start)
+                query_time.record(done - checked_out)
+                latency.record(done - start)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load") as executor:
+            for future in [executor.submit(worker, start + duration) for _ in range(concurrency)]:
+                future.result()
+        elapsed = time.monotonic() - start
+        pool = engine.pool
+        return {"query": query, "concurrency": concurrency, "duration_s": round(elapsed, 3),
+                "queries": latency.count, "qps": round(latency.count / elapsed, 1) if elapsed else 0.0,
+                "errors": errors, "pool_size": pool.size(),
+                "latency": latency.as_dict(), "pool_wait": pool_wait.as_dict(), "query_time": query_time.as_dict()}
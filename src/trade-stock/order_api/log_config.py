@@ -0,0 +1,53 @@
+import contextvars
+import logging
+import random
+from pythonjsonlogger import jsonlogger
+
+# the TradeOrderStack metric filters match on the levelname, exc_info and az fields of these records
+LOG_FORMAT = '%(levelname)s %(lineno)d %(asctime)s %(task)-32s %(az)-10s - %(message)s'
+
+_request_sampled = contextvars.ContextVar("request_sampled", default=True)
+
+
+class LogSampler(logging.Filter):
+    """
+    Keeps INFO and DEBUG records for a sample of requests, decided once per request by begin_request() so a sampled
+    request keeps all of its records. WARNING and above are always kept, as is anything logged outside a request.
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def begin_request(self) -> None:
+        _request_sampled.set(self.rate >= 1.0 or random.random() < self.rate)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or _request_sampled.get()
+
+
+class SampledRequestLogs:
+    """ASGI middleware that starts each HTTP request with a LogSampler decision."""
+
+    def __init__(self, app, sampler: LogSampler):
+        self.app = app
+        self.sampler = sampler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            self.sampler.begin_request()
+        await self.app(scope, receive, send)
+
+
+def configure_logging(name: str, sample_rate: float = 1.0, level: int = logging.INFO) -> tuple:
+    """
+    JSON logging to stderr for the named logger, returns (logger, sampler).
+    Records are only formatted once the level and the sampler let them through, so log with %s arguments
+    rather than str.format() to avoid building messages that are dropped.
+    """
+    json_handler = logging.StreamHandler()
+    json_handler.setFormatter(jsonlogger.JsonFormatter(LOG_FORMAT))
+    sampler = LogSampler(sample_rate)
+    json_handler.addFilter(sampler)
+    logging.basicConfig(handlers=[json_handler], level=level)
+    return logging.getLogger(name), sampler
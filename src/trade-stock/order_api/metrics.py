@@ -0,0 +1,166 @@
+import json
+import logging
+import threading
+import time
+
+
+class MetricsEmitter:
+    """
+    Aggregates count metrics, and keeps the latest value of gauge metrics, in memory and writes them out in batches
+    instead of calling CloudWatch on every request.
+    By default each flush writes one CloudWatch Embedded Metric Format (EMF) JSON line per dimension value to the
+    container log, and CloudWatch Logs extracts the metrics from the log group asynchronously.
+    Optionally, a background flusher sends the aggregated datums with PutMetricData, up to 1000 datums per call.
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+    MAX_DATUMS_PER_CALL = 1000
+
+    def __init__(self, namespace: str, dimension_name: str, dimension_value: str, logger: logging.Logger,
+                 cw_client=None, flush_interval: float = 10.0, log_extra: dict = None, on_increment=None):
+        self.namespace = namespace
+        self.dimension_name = dimension_name
+        self.dimension_value = dimension_value
+        self.logger = logger
+        self.cw_client = cw_client
+        self.flush_interval = flush_interval
+        self.log_extra = log_extra or {}
+        # called with (metric name, value) on every increment, to count the same events in another registry
+        self.on_increment = on_increment
+        self._counts = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flusher = None
+        self._stopped = threading.Event()
+        # the json formatter drops underscore keys such as "_aws", so EMF lines are serialized here and written raw
+        self.emf_logger = logging.getLogger("{}.emf".format(logger.name))
+        if not self.emf_logger.handlers:
+            emf_handler = logging.StreamHandler()
+            emf_handler.setFormatter(logging.Formatter('%(message)s'))
+            self.emf_logger.addHandler(emf_handler)
+            self.emf_logger.setLevel(logging.INFO)
+            self.emf_logger.propagate = False
+
+    def increment(self, metric_name: str, value: float = 1, dimension_value: str = None) -> None:
+        """Add to the in-memory counter for (metric, dimension). Flushes inline when the interval has passed."""
+        key = (metric_name, dimension_value or self.dimension_value)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+        if self.on_increment is not None:
+            self.on_increment(metric_name, value)
+        if self._flusher is None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def gauge(self, metric_name: str, value: float, unit: str = "Count", dimension_value: str = None) -> None:
+        """Set a point-in-time metric such as connections in use, only the latest value before a flush is sent."""
+        key = (metric_name, dimension_value or self.dimension_value)
+        with self._lock:
+            self._gauges[key] = (value, unit)
+
+    def _drain(self) -> dict:
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            gauges, self._gauges = self._gauges, {}
+            self._last_flush = time.monotonic()
+        datums = {key: (value, "Count") for key, value in counts.items()}
+        datums.update(gauges)
+        return datums
+
+    def flush(self) -> None:
+        """Write out and reset all aggregated counters and gauges."""
+        datums = self._drain()
+        if not datums:
+            return
+        if self.cw_client is not None:
+            self._put_metric_data(datums)
+        else:
+            self._write_emf(datums)
+
+    def _write_emf(self, datums: dict) -> None:
+        by_dimension = {}
+        for (metric_name, dimension_value), value_unit in datums.items():
+            by_dimension.setdefault(dimension_value, {})[metric_name] = value_unit
+        for dimension_value, metrics in by_dimension.items():
+            emf = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [[self.dimension_name]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()]
+                    }]
+                },
+                self.dimension_name: dimension_value,
+            }
+            emf.update({name: value for name, (value, _) in metrics.items()})
+            emf.update(self.log_extra)
+            self.emf_logger.info(json.dumps(emf))
+
+    def _put_metric_data(self, metrics: dict) -> None:
+        datums = [{
+            "MetricName": metric_name,
+            "Dimensions": [{"Name": self.dimension_name, "Value": dimension_value}],
+            "Value": value,
+            "Unit": unit
+        } for (metric_name, dimension_value), (value, unit) in metrics.items()]
+        for start in range(0, len(datums), self.MAX_DATUMS_PER_CALL):
+            try:
+                self.cw_client.put_metric_data(Namespace=self.namespace,
+                                               MetricData=datums[start:start + self.MAX_DATUMS_PER_CALL])
+            except Exception as e:
+                # metrics are best effort, never fail the caller, but leave a trace in the log instead
+                self.logger.error("put_metric_data failed, dropping {} datums: {}".format(
+                    len(datums[start:start + self.MAX_DATUMS_PER_CALL]), e),
+                    extra=self.log_extra)
+
+    def start_background_flusher(self) -> None:
+        """Flush from a daemon thread on a fixed interval so no request ever pays for a flush."""
+        if self._flusher is not None:
+            return
+
+        def run():
+            while not self._stopped.wait(self.flush_interval):
+                self.flush()
+
+        self._flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def stop(self) -> None:
+        """Stop the background flusher, if any, and flush what is left."""
+        self._stopped.set()
+        self.flush()
+
+
+class GaugeSampler:
+    """
+    Records gauges from a daemon thread on a fixed interval, so request handlers such as health checks only read
+    in-memory state. sample is a callable returning {metric name: value}.
+    """
+
+    def __init__(self, metrics: MetricsEmitter, sample, logger: logging.Logger, extra: dict = None,
+                 interval: float = 10.0):
+        self.metrics = metrics
+        self.sample = sample
+        self.logger = logger
+        self.extra = extra or {}
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self) -> None:
+        for metric_name, value in self.sample().items():
+            self.metrics.gauge(metric_name, value)
+
+    def start(self) -> None:
+        def run():
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.record()
+                except Exception as e:
+                    self.logger.warning("Gauge sampling failed: %s", e, extra=self.extra)
+
+        self._thread = threading.Thread(target=run, name="gauge-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
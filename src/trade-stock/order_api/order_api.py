@@ -1,66 +1,135 @@
 #!/bin/python3
 
+import atexit
 import functools
 from flask import Flask, request, Response
-from flask_api import status
-import json
 import logging
 import boto3
-import requests
-import random
 import os
-import urllib.parse
-from pythonjsonlogger import jsonlogger
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from circuitbreaker import circuit
 from circuitbreaker import CircuitBreakerMonitor
-from retry.api import retry_call
+from circuitbreaker import CircuitBreaker
+import requests
 from botocore.exceptions import ClientError
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy import select
-from sqlalchemy import text
 from sqlalchemy import exc
+from sqlalchemy import event
 from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
 from data_objects import Customer, Activity, Symbol, TradeState, TransactionType
 from trade_parameter_name import TradeParameterName
+from metrics import MetricsEmitter, GaugeSampler
+from symbol_cache import SymbolCache
+from repository import OrderRepository
+from order_state import OrderStateEngine
+from idempotency import IdempotentOrders
+from balances import CustomerLedger
+from outbox import FileQueue, OrderOutbox
+from reader_routing import ReaderEndpoint, ReaderRouter, discover_readers
+from latency import RollingHistogram
+from load_generator import LoadGenerator
+from admission import GradientLimiter, AdmissionControl
+from shared_circuit import SharedCircuitBreaker
+from confirms_client import ConfirmsClient
+from confirms_retry import RetryBudget, RetryingCaller
+from startup import StartupTimings, load_config, warm_up_in_background
+from db_pool import PoolTelemetry, PoolSizer, PoolMonitor, live_task_count
+from db_credentials import RotatingCredentials
+from log_config import configure_logging
+from prometheus_client import Gauge, Histogram
+from prometheus_metrics import EVENTS, LATENCY_BUCKETS, PrometheusMiddleware, exposition
+from tracing import Tracer, TracingMiddleware, exporter_from
 
 
 class ConfirmsUnavailableError(RuntimeError):
     pass
 
 
-json_handler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter('%(levelname)s %(lineno)d %(asctime)s %(task)-32s %(az)-10s - %(message)s')
-json_handler.setFormatter(formatter)
-logging.basicConfig(handlers=[json_handler], level=logging.INFO)
-logger = logging.getLogger('orders')
+DB_POOL_CHECKOUT = Histogram("db_pool_checkout_seconds", "Wait to check a connection out of a pool", ["pool"],
+                             buckets=LATENCY_BUCKETS)
+CONFIRMS_LATENCY = Histogram("confirms_call_duration_seconds", "Latency of one confirms call attempt", ["outcome"],
+                             buckets=LATENCY_BUCKETS)
+# the circuit state is shared by the workers of a task, the most recent sample of any worker is the state
+CIRCUIT_STATE = Gauge("confirms_circuit_state", "1 for the current confirms circuit state", ["state"],
+                      multiprocess_mode="mostrecent")
 
-meta_data_uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
-tr = requests.get("{}/task".format(meta_data_uri), timeout=.05).json()
+# INFO and DEBUG records are kept for LOG_SAMPLE_RATE of requests, warnings and errors are always kept
+logger, log_sampler = configure_logging('orders', sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', '1')))
+
+# task metadata and all SSM parameters are fetched concurrently, with one GetParameters call
+startup_timings = StartupTimings()
+tr, parameters = load_config(startup_timings, [TradeParameterName.TRADE_ORDER_API_SECRET_ID.value,
+                                               TradeParameterName.TRADE_CONFIRMS_ENDPOINT.value,
+                                               TradeParameterName.TRADE_RDS_PROXY_READ_ONLY_ENDPOINT.value])
 logger.info(tr)
 availability_zone_ = tr['AvailabilityZone']
 d = {'az': availability_zone_}
 
-cw_client = boto3.client('cloudwatch')
-ssm_client = boto3.client('ssm')
-secret_id = ssm_client.get_parameter(Name=TradeParameterName.TRADE_ORDER_API_SECRET_ID.value)['Parameter']['Value']
-confirms_endpoint = ssm_client.get_parameter(Name=TradeParameterName.TRADE_CONFIRMS_ENDPOINT.value)['Parameter'][
-    'Value']
-rds_proxy_endpoint = ssm_client.get_parameter(Name=TradeParameterName.TRADE_RDS_PROXY_ENDPOINT.value)['Parameter'][
-    'Value']
-rds_ro_proxy_endpoint = ssm_client.get_parameter(Name=TradeParameterName.TRADE_RDS_PROXY_READ_ONLY_ENDPOINT.value)[
-    'Parameter']['Value']
+# EMF (default) writes metrics to the log; put_metric_data sends them to CloudWatch
+# both flush from a background thread, so sampled gauges are written even when no orders arrive
+metrics_mode = os.environ.get('METRICS_MODE', 'emf')
+metrics = MetricsEmitter(namespace="TradeOrder", dimension_name="AvailabilityZone",
+                         dimension_value=availability_zone_, logger=logger,
+                         cw_client=boto3.client('cloudwatch') if metrics_mode == 'put_metric_data' else None,
+                         flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', '10')), log_extra=d,
+                         on_increment=lambda metric_name, value: EVENTS.labels(metric_name).inc(value))
+atexit.register(metrics.stop)
+
+# spans around the stages of /trade/, exported for TRACE_SAMPLE_RATE of requests through TRACE_EXPORTER:
+# log, otlp to a collector at TRACE_ENDPOINT, or xray to the daemon at TRACE_ENDPOINT; none by default
+tracer = Tracer(exporter_from(os.environ.get('TRACE_EXPORTER', 'none'), logger, d,
+                              endpoint=os.environ.get('TRACE_ENDPOINT'), service_name="trade-order"),
+                sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', '1')), logger=logger)
+
+secret_id = parameters[TradeParameterName.TRADE_ORDER_API_SECRET_ID.value]
+confirms_endpoint = parameters[TradeParameterName.TRADE_CONFIRMS_ENDPOINT.value]
+rds_ro_proxy_endpoint = parameters[TradeParameterName.TRADE_RDS_PROXY_READ_ONLY_ENDPOINT.value]
+confirms_client = ConfirmsClient(confirms_endpoint,
+                                 pool_size=int(os.environ.get('CONFIRMS_POOL_SIZE', '10')),
+                                 connect_timeout=float(os.environ.get('CONFIRMS_CONNECT_TIMEOUT', '.1')),
+                                 read_timeout=float(os.environ.get('CONFIRMS_READ_TIMEOUT', '.3')),
+                                 keep_alive=os.environ.get('CONFIRMS_KEEP_ALIVE', 'true') == 'true')
+# confirms calls for a batch of orders run concurrently, one thread per pooled confirms connection
+confirms_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('CONFIRMS_POOL_SIZE', '10')),
+                                       thread_name_prefix="confirms")
+trade_batch_max_orders = int(os.environ.get('TRADE_BATCH_MAX_ORDERS', '100'))
 secrets_cache = None
 db_engine = None
-ro_db_engine = None
-
-
-def get_db_credentials_from_cache() -> str:
-    """
-    Uses AWS Secrets Manager and Secret Cache to retrieve database credentials with multi-user rotation strategy.
-    Turns a hard dependency into a soft dependency by caching the credentials.
-    """
-    global secrets_cache, secret_id
+reader_router = None
+engine_lock = threading.Lock()
+# adaptive sizing shares a connection budget per database instance across every worker of every live task,
+# fixed keeps the original pool of 10 plus overflow per worker
+pool_sizing = os.environ.get('DB_POOL_SIZING', 'adaptive')
+expected_task_count = int(os.environ.get('DB_EXPECTED_TASK_COUNT', '9'))
+# rolling latency histograms over the last LATENCY_WINDOW seconds, served at /metrics/latency
+latency_window = float(os.environ.get('LATENCY_WINDOW', '60'))
+trade_latency = RollingHistogram(window=latency_window)
+writer_pool_telemetry = PoolTelemetry("Writer", histogram=RollingHistogram(window=latency_window),
+                                      on_wait=DB_POOL_CHECKOUT.labels("writer").observe)
+reader_pool_telemetry = PoolTelemetry("Reader", histogram=RollingHistogram(window=latency_window),
+                                      on_wait=DB_POOL_CHECKOUT.labels("reader").observe)
+load_generator = LoadGenerator(max_concurrency=int(os.environ.get('DB_STRESS_MAX_CONCURRENCY', '32')),
+                               max_duration=float(os.environ.get('DB_STRESS_MAX_DURATION', '1.5')))
+writer_pool_sizer = PoolSizer(budget=int(os.environ.get('DB_WRITER_CONNECTION_BUDGET', '24')),
+                              workers_per_task=int(os.environ.get('WEB_CONCURRENCY', '1')),
+                              max_pool_size=int(os.environ.get('DB_POOL_MAX_SIZE', '10')), tasks=expected_task_count)
+reader_pool_sizer = PoolSizer(budget=int(os.environ.get('DB_READER_CONNECTION_BUDGET', '72')),
+                              workers_per_task=int(os.environ.get('WEB_CONCURRENCY', '1')),
+                              max_pool_size=int(os.environ.get('DB_POOL_MAX_SIZE', '10')), tasks=expected_task_count)
+order_states = OrderStateEngine()
+repository = OrderRepository()
+symbol_cache = SymbolCache(max_size=int(os.environ.get('SYMBOL_CACHE_SIZE', '1024')),
+                           ttl=float(os.environ.get('SYMBOL_CACHE_TTL', '60')))
+customer_ledger = CustomerLedger(ttl=float(os.environ.get('BALANCE_CACHE_TTL', '5')))
+idempotent_orders = IdempotentOrders(max_size=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '4096')))
+
+
+def get_secrets_cache() -> SecretCache:
+    """The Secrets Manager cache, created on first use."""
+    global secrets_cache
     try:
         if secrets_cache is None:
             boto_session = boto3.session.Session()
@@ -69,39 +138,153 @@ def get_db_credentials_from_cache() -> str:
             secrets_cache = SecretCache(config=cache_config, client=secrets_client)
     except ClientError as e:
         raise e
-    return secrets_cache.get_secret_string(secret_id=secret_id)
+    return secrets_cache
+
+
+def get_db_credentials_from_cache() -> str:
+    """
+    Uses AWS Secrets Manager and Secret Cache to retrieve database credentials with multi-user rotation strategy.
+    Turns a hard dependency into a soft dependency by caching the credentials.
+    """
+    return get_secrets_cache().get_secret_string(secret_id=secret_id)
+
+
+db_credentials = RotatingCredentials(get_secrets_cache, secret_id)
+
+
+def pool_args(telemetry: PoolTelemetry, sizer: PoolSizer) -> dict:
+    """Pool arguments for create_engine, every pool reports checkout waits through its telemetry."""
+    if pool_sizing != 'adaptive':
+        return {"poolclass": telemetry.pool_class, "pool_size": 10}
+    # no overflow, the budget is a hard ceiling, and fail a checkout well inside the gunicorn timeout
+    return {"poolclass": telemetry.pool_class, "pool_size": sizer.pool_size(), "max_overflow": 0,
+            "pool_timeout": float(os.environ.get('DB_POOL_TIMEOUT', '1'))}
 
 
 def load_db_engine() -> None:
-    """Load and cache read-write SQLAlchemy database connection. Refreshes credentials on each invocation."""
+    """
+    Load and cache read-write SQLAlchemy database connection.
+    The user and password are set on each new connection by db_credentials, so rotation needs no new engine.
+    """
     global db_engine
-    secret = json.loads(get_db_credentials_from_cache())
+    secret = db_credentials.current()
     host_ = secret['host']
-    # host_ = rds_proxy_endpoint
-    password = urllib.parse.quote_plus(secret['password'])
-    db_conn_string = f"postgresql://{secret['username']}:{password}@{host_}:{secret['port']}/{secret['dbname']}?sslmode=require"
+    db_conn_string = f"postgresql://{host_}:{secret['port']}/{secret['dbname']}?sslmode=require"
     # if you are having trouble recreating connection pool exhaustion,
     # try creating the db engine with the default timeout so slower connections don't timeout at 100ms
-    #db_engine = create_engine(db_conn_string, pool_size=10)
-    db_engine = create_engine(db_conn_string, pool_size=10, connect_args={"options": "-c statement_timeout=100"})
+    #db_engine = create_engine(db_conn_string, **pool_args(writer_pool_telemetry, writer_pool_sizer))
+    db_engine = create_engine(db_conn_string, **pool_args(writer_pool_telemetry, writer_pool_sizer),
+                              connect_args={"options": "-c statement_timeout=100"})
+    event.listen(db_engine, "do_connect", db_credentials.inject)
 
 
 def load_ro_db_engine() -> None:
-    """Load and cache read-only SQLAlchemy database connection. Refreshes credentials on each invocation."""
-    global ro_db_engine
-    secret = json.loads(get_db_credentials_from_cache())
-    host_ = secret['host'].replace("stock.cluster", "stock.cluster-ro")
-    # host_ = rds_ro_proxy_endpoint
-    password = urllib.parse.quote_plus(secret['password'])
-    db_conn_string = f"postgresql://{secret['username']}:{password}@{host_}:{secret['port']}/{secret['dbname']}?sslmode=require"
-    ro_db_engine = create_engine(db_conn_string, pool_size=10)
+    """
+    Load and cache the reader router, which holds one read-only engine per reader endpoint, credentials are set the
+    same way as load_db_engine. READER_ROUTING picks the endpoints: instances routes over the reader instances of
+    the cluster, proxy uses the read-only RDS Proxy endpoint and cluster the cluster reader endpoint.
+    """
+    global reader_router
+    secret = db_credentials.current()
+    routing = os.environ.get('READER_ROUTING', 'instances')
+    cluster_endpoint = ReaderEndpoint("cluster-ro", secret['host'].replace("stock.cluster", "stock.cluster-ro"))
+    endpoints = [cluster_endpoint]
+    if routing == 'proxy':
+        endpoints = [ReaderEndpoint("proxy", rds_ro_proxy_endpoint)]
+    elif routing == 'instances':
+        try:
+            endpoints = discover_readers(os.environ.get('DB_CLUSTER_ID', 'stock')) or endpoints
+        except Exception as e:
+            logger.warning("Reader discovery failed, using the cluster reader endpoint: %s", e, extra=d)
+    logger.info("Routing reads over %s", [(endpoint.name, endpoint.availability_zone) for endpoint in endpoints],
+                extra=d)
+    # DB_READER_CONNECTION_BUDGET covers every reader, an engine per reader instance gets its share of it
+    reader_pool_sizer.instances = len(endpoints)
+
+    def create_reader_engine(host: str):
+        engine = create_engine(f"postgresql://{host}:{secret['port']}/{secret['dbname']}?sslmode=require",
+                               **pool_args(reader_pool_telemetry, reader_pool_sizer))
+        event.listen(engine, "do_connect", db_credentials.inject)
+        return engine
+
+    reader_router = ReaderRouter(endpoints, create_reader_engine, get_db_engine, availability_zone_, metrics,
+                                 logger, d, max_lag_ms=float(os.environ.get('READER_MAX_LAG_MS', '1000')),
+                                 interval=float(os.environ.get('READER_LAG_CHECK_INTERVAL', '5')),
+                                 track_each_reader=routing == 'instances' and cluster_endpoint not in endpoints)
+    reader_router.start()
+
+
+def get_db_engine():
+    """The read-write engine, created on first use unless the startup warm-up already created it."""
+    if db_engine is None:
+        with engine_lock:
+            if db_engine is None:
+                load_db_engine()
+    return db_engine
+
+
+def get_ro_db_engine():
+    """
+    The read-only engine the reader router picks for this read, or the writer engine while every reader lags.
+    The router is created on first use unless the startup warm-up already created it.
+    """
+    if reader_router is None:
+        with engine_lock:
+            if reader_router is None:
+                load_ro_db_engine()
+    return reader_router.engine()
+
+
+def resize_pool(name: str, size: int) -> None:
+    """Replace an engine with one sized for the live task count, and close the idle connections of the old one."""
+    with engine_lock:
+        if name == writer_pool_telemetry.name:
+            old_engine = db_engine
+            load_db_engine()
+        else:
+            old_engine = reader_router
+            load_ro_db_engine()
+            old_engine.stop()
+    logger.info("%s pool resized to %s", name, size, extra=d)
+    old_engine.dispose()
+
+
+def size_pools() -> None:
+    """Size the pools for the live task count before the engines are created."""
+    tasks = live_task_count(tr, expected_task_count)
+    writer_pool_sizer.tasks = reader_pool_sizer.tasks = tasks
+    logger.info("Sizing pools for %s tasks, writer %s reader %s",
+                tasks, writer_pool_sizer.pool_size(), reader_pool_sizer.pool_size(), extra=d)
+
+
+pool_monitor = PoolMonitor(pools=lambda: [(writer_pool_telemetry, db_engine, writer_pool_sizer),
+                                          (reader_pool_telemetry, reader_router, reader_pool_sizer)],
+                           task_count=lambda: live_task_count(tr, expected_task_count),
+                           on_resize=resize_pool, metrics=metrics, logger=logger, extra=d,
+                           interval=float(os.environ.get('DB_POOL_TELEMETRY_INTERVAL', '30')),
+                           resize_interval=float(os.environ.get('DB_POOL_RESIZE_INTERVAL', '300'))
+                           if pool_sizing == 'adaptive' else float('inf'))
+
+
+# ORDER_WRITE_MODE=outbox writes single orders behind the request through a local outbox drained in batches,
+# sync writes them on the request path
+order_outbox = None
+if os.environ.get('ORDER_WRITE_MODE', 'sync') == 'outbox':
+    order_outbox = OrderOutbox(FileQueue(os.environ.get('OUTBOX_DIR', '/tmp/order-outbox'),
+                                         fsync=os.environ.get('OUTBOX_FSYNC', 'true') == 'true'),
+                               get_db_engine, customer_ledger, logger, d,
+                               interval=float(os.environ.get('OUTBOX_DRAIN_INTERVAL', '.05')),
+                               max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5')))
+    atexit.register(order_outbox.stop)
 
 
 def connection_aware(func):
     """
     A decorator to refresh database connections if failing to connect after rotation
     indicated by a sqlalchemy.exc.OperationalError wrapping a psycopg2.OperationalError.
-    This decorator only retries once, and it does a full refresh of the database credentials and SQLAlchemy engine.
+    This decorator only retries once. It refreshes the cached credentials, and only if they changed it disposes
+    the pools of both engines: idle connections are closed and checked out connections are closed when returned,
+    while new connections log in with the new password. The engines themselves are kept.
     Decorate any functions that make a database connection to gracefully handle failures due to password change
     or intermittent connectivity issues.
     """
@@ -110,161 +293,527 @@ def connection_aware(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except exc.OperationalError as e:
-            logger.exception("db credentials reloaded, retrying", e, extra=d)
-            load_db_engine()
-            load_ro_db_engine()
+        except exc.OperationalError:
+            logger.exception("db operation failed, retrying", extra=d)
+            if db_credentials.refresh():
+                logger.info("db credentials rotated, draining connection pools", extra=d)
+                for engine in (db_engine, reader_router):
+                    if engine is not None:
+                        engine.dispose()
             return func(*args, **kwargs)
 
     return wrapper
 
 
-def current_price(ticker: str, session: Session) -> Symbol:
-    """
-    Lookup current stock price from the database.
-    In a real system, this database would be connected to the stock stream; it is static for this example.
-    """
-    logger.info("Checking Stock Price", extra=d)
-    statement = select(Symbol).where(Symbol.ticker == ticker)
-    symbol_record = session.scalars(statement).one()
-    logger.info("Here's your symbol: {}".format(symbol_record.as_dict()), extra=d)
-    return symbol_record
-
-
 def get_customer(customer_id: str, session: Session) -> Customer:
     """
-    Lookup customer from the database, add a semi-random cash balance.
-    In a real system, a customer would have a cash balance or deposit accounts for purchasing with.
+    Lookup customer from the database, including the cash balance buy orders are reserved from.
+    The balance read from the reader may lag, customer_ledger reserves against the writer.
     """
     logger.info("Checking Customer Balance", extra=d)
-    statement = select(Customer).where(Customer.id == customer_id)
-    customer_record = session.scalars(statement).one()
-    logger.info("Here's your customer: {}".format(customer_record.as_dict()), extra=d)
+    customer_record = repository.customer(session, customer_id)
+    logger.info("Here's your customer: %s", customer_record, extra=d)
     return customer_record
 
 
-def place_order(customer: Customer, symbol: Symbol, json_request, session: Session) -> Activity:
+def get_customer_and_symbol(customer_id: str, ticker: str, session: Session, expected_price=None) -> tuple:
+    """
+    Lookup the customer and the symbol for an order with a single round trip to the reader.
+    A cached symbol with the expected price only needs the customer lookup; otherwise both rows come back from
+    one statement, and a missing customer or symbol still raises NoResultFound just like the separate lookups.
     """
-    create a new trade record in the database making it ready to place with the exchange
+    with tracer.span("symbol_lookup"):
+        symbol_record = symbol_cache.get(ticker)
+    if symbol_record is not None and (expected_price is None or float(symbol_record.close) == float(expected_price)):
+        with tracer.span("customer_lookup"):
+            return get_customer(customer_id, session), symbol_record
+
+    logger.info("Checking Customer Balance and Stock Price", extra=d)
+    # the symbol and customer lookups share one round trip, so one span times both
+    with tracer.span("customer_lookup", symbol=True):
+        customer_record, symbol_record = repository.customer_and_symbol(session, customer_id, ticker)
+    session.expunge(symbol_record)
+    symbol_record = symbol_cache.put(symbol_record)
+    logger.info("Here's your customer: %s and symbol: %s", customer_record, symbol_record, extra=d)
+    return customer_record, symbol_record
+
+
+def get_customers_and_symbols(orders: list, session: Session) -> tuple:
     """
-    logger.info("JSON request before insert: {}".format(json_request), extra=d)
+    Lookup the customers and symbols for a batch of orders with one IN query each.
+    Symbols cached at every expected price in the batch are not read again.
+    Returns (customers by id, symbols by ticker); an unknown customer or ticker is missing from the result.
+    """
+    symbols = {}
+    stale_tickers = set()
+    for order in orders:
+        ticker = order['ticker']
+        symbol_record = symbols.get(ticker) or symbol_cache.get(ticker)
+        if symbol_record is None or float(symbol_record.close) != float(order['current_price']):
+            stale_tickers.add(ticker)
+        else:
+            symbols[ticker] = symbol_record
+    for ticker in stale_tickers:
+        symbols.pop(ticker, None)
+
+    customer_ids = {str(order['customer_id']) for order in orders}
+    customers = {str(customer.id): customer for customer in repository.customers(session, customer_ids)}
+    if stale_tickers:
+        for symbol_record in repository.symbols(session, stale_tickers):
+            session.expunge(symbol_record)
+            symbols[symbol_record.ticker] = symbol_cache.put(symbol_record)
+    logger.info("Found %s of %s customers and %s of %s symbols for %s orders", len(customers), len(customer_ids),
+                len(symbols), len({order['ticker'] for order in orders}), len(orders), extra=d)
+    return customers, symbols
+
+
+def place_order(customer: Customer, symbol: Symbol, json_request, session: Session,
+                status: TradeState = TradeState.submitted) -> Activity:
+    """
+    create a new trade record in the database in its initial state with a single insert
+    """
+    logger.info("JSON request before insert: %s", json_request, extra=d)
+    return order_states.open(session, new_activity(customer, symbol, json_request, status))
+
+
+def new_activity(customer: Customer, symbol: Symbol, json_request, status: TradeState) -> Activity:
+    """A trade record for an order request, not yet added to a session."""
     activity = Activity()
     activity.customer_id = customer.id
     activity.symbol_ticker = symbol.id
-    activity.status = TradeState.submitted
+    activity.status = status
     activity.type = TransactionType(json_request["transaction_type"])
     activity.share_count = json_request["share_count"]
     activity.current_price = json_request["current_price"]
     activity.request_id = json_request["request_id"]
-    session.add(activity)
+    return activity
+
+
+def move_order(session: Session, activity: Activity, new_state: TradeState, refund: float = 0) -> Activity:
+    """
+    Move an order to a new state, through the outbox in write-behind mode, and credit refund back to the customer.
+    """
+    if order_outbox is not None:
+        return order_outbox.transition(activity, new_state, refund)
+    order_states.transition(session, activity, new_state, refund)
+    if refund:
+        customer_ledger.invalidate(activity.customer_id)
     return activity
 
 
 def put_count_metric(metric_name: str):
-    # Todo, this can be improved by using the EMF, https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
-    cw_client.put_metric_data(
-        Namespace="TradeOrder",
-        MetricData=[{
-            "MetricName": metric_name,
-            "Dimensions": [
-                {
-                    "Name": "AvailabilityZone",
-                    "Value": availability_zone_
-                }
-            ],
-            "Value": 1,
-            "Unit": "Count"
-        }]
-    )
-
-
-@circuit(failure_threshold=5, expected_exception=ConfirmsUnavailableError, recovery_timeout=60)
-def execute_trade(activity: dict) -> Response:
-    response = requests.post("http://{}/confirm-trade/".format(confirms_endpoint), json=activity, timeout=.3)
-    logger.info(f"response: {response.status_code} for {response.reason}", extra=d)
-    if "ConfirmsMaintenanceError" in response.reason:
-        raise ConfirmsUnavailableError(response.json()) # triggers circuit breaker
+    """
+    Count one occurrence of a metric in the TradeOrder namespace with the AvailabilityZone dimension.
+    Counts are aggregated in memory and flushed in batches, so no CloudWatch round trip happens on the request path.
+    """
+    with tracer.span("metrics", metric=metric_name):
+        metrics.increment(metric_name)
+
+
+def confirm_trade(activity: dict) -> Response:
+    """One call to the confirms service."""
+    start = time.perf_counter()
+    try:
+        response = confirms_client.post("/confirm-trade/", json=activity)
+    except Exception:
+        CONFIRMS_LATENCY.labels("error").observe(time.perf_counter() - start)
+        raise
+    CONFIRMS_LATENCY.labels(str(response.status_code)).observe(time.perf_counter() - start)
+    logger.info("response: %s for %s", response.status_code, response.reason, extra=d)
+    # the maintenance error is in the body, the reason is only the HTTP status text
+    if "ConfirmsMaintenanceError" in response.text:
+        raise ConfirmsUnavailableError(response.text)  # triggers circuit breaker
     response.raise_for_status()  # triggers retries
     return response
 
 
+def retryable_confirms_error(error: Exception) -> bool:
+    """Timeouts, dropped connections and 5xx answers are worth another attempt, exchange maintenance is not."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+# retries and hedges share a per-process budget, and all attempts for an order fit in CONFIRMS_DEADLINE seconds,
+# well inside the 2 second gunicorn timeout
+confirms_caller = RetryingCaller(RetryBudget(ratio=float(os.environ.get('CONFIRMS_RETRY_BUDGET_RATIO', '.1'))),
+                                 should_retry=retryable_confirms_error, metrics=metrics,
+                                 max_attempts=int(os.environ.get('CONFIRMS_MAX_ATTEMPTS', '3')),
+                                 attempt_timeout=sum(confirms_client.timeout),
+                                 deadline=float(os.environ.get('CONFIRMS_DEADLINE', '1')),
+                                 hedging=os.environ.get('CONFIRMS_HEDGING', 'false') == 'true',
+                                 hedge_percentile=float(os.environ.get('CONFIRMS_HEDGE_PERCENTILE', '95')),
+                                 hedge_workers=int(os.environ.get('CONFIRMS_POOL_SIZE', '10')))
+
+
+# the circuit state is shared by all workers of the task, CIRCUIT_SHARED=false keeps it per worker
+@circuit(failure_threshold=5, expected_exception=ConfirmsUnavailableError, recovery_timeout=60,
+         cls=SharedCircuitBreaker if os.environ.get('CIRCUIT_SHARED', 'true') == 'true' else CircuitBreaker)
+def execute_trade(activity: dict) -> Response:
+    return confirms_caller.call(functools.partial(confirm_trade, activity))
+
+
+def circuit_state_gauges() -> dict:
+    """One gauge per confirms circuit state, 1 for the current state and 0 for the others, also set in Prometheus."""
+    state = CircuitBreakerMonitor.get('execute_trade').state
+    for circuit_state in ("open", "half_open", "closed"):
+        CIRCUIT_STATE.labels(circuit_state).set(int(state == circuit_state))
+    return {"ConfirmsCircuitOpen": int(state == "open"),
+            "ConfirmsCircuitClosed": int(state == "closed"),
+            "ConfirmsCircuitUnknown": int(state not in ("open", "closed"))}
+
+
+gauge_samplers = [GaugeSampler(metrics, circuit_state_gauges, logger, d,
+                               interval=float(os.environ.get('CIRCUIT_STATE_INTERVAL', '10')))]
+if order_outbox is not None:
+    gauge_samplers.append(GaugeSampler(metrics, lambda: {"OutboxBacklog": order_outbox.backlog,
+                                                         "OutboxDeadLetters": order_outbox.dead_letters}, logger, d,
+                                       interval=float(os.environ.get('CIRCUIT_STATE_INTERVAL', '10'))))
+
+
+def initial_trade_state(symbol_record: Symbol, json_request, affordable: bool) -> TradeState:
+    """
+    pending when the order can be sent to the exchange, aborted while the confirms circuit is open,
+    rejected when the price moved or the customer cannot afford it
+    """
+    circuit_state = CircuitBreakerMonitor.get('execute_trade').state
+    if circuit_state == "closed" \
+            and float(symbol_record.close) == float(json_request['current_price']) \
+            and affordable:
+        return TradeState.pending
+    elif circuit_state == "open":
+        return TradeState.aborted
+    return TradeState.rejected
+
+
+def confirm_order(activity: dict) -> TradeState:
+    """Send one order of a batch to the exchange, returns filled, or aborted if the confirms call failed."""
+    try:
+        result = execute_trade(activity)
+        logger.info("exchange call result: %s", result, extra=d)
+        return TradeState.filled
+    except Exception as e:
+        logger.error("Processing failed for %s: %s", activity['request_id'], e, extra=d)
+        return TradeState.aborted
+
+
+def warm_connection_pools() -> None:
+    """Open one connection on each engine so the first trade does not pay for the TLS handshake and login."""
+    for engine in (get_db_engine(), get_ro_db_engine()):
+        with engine.connect():
+            pass
+
+
+def warm_symbol_cache() -> None:
+    with Session(get_ro_db_engine()) as warm_session:
+        logger.info("Warmed symbol cache with %s symbols", symbol_cache.warm(warm_session), extra=d)
+
+
 app = Flask(__name__)
-load_db_engine()
-load_ro_db_engine()
+app.before_request(log_sampler.begin_request)
+# orders beyond the adaptive concurrency limit get a fast 503, health checks and /region-az/ are never shed
+admission_limiter = GradientLimiter(initial_limit=int(os.environ.get('ADMISSION_INITIAL_LIMIT', '8')),
+                                    max_limit=int(os.environ.get('ADMISSION_MAX_LIMIT', '64')))
+# the limit counts the requests one worker process serves at once, a sync worker only ever serves one, so by
+# default (ADMISSION_CONTROL=auto) it only applies to the gthread and gevent profiles of gunicorn.conf.py
+admission_control = os.environ.get('ADMISSION_CONTROL', 'auto')
+if admission_control == 'auto':
+    concurrent_workers = os.environ.get('GUNICORN_PROFILE', 'sync') in ('gthread', 'gevent') \
+        or int(os.environ.get('GUNICORN_THREADS', '1')) > 1
+    admission_control = 'true' if concurrent_workers else 'false'
+if admission_control == 'true':
+    app.wsgi_app = AdmissionControl(app.wsgi_app, admission_limiter, limited_paths={"/trade/", "/trades/"},
+                                    retry_after=int(os.environ.get('ADMISSION_RETRY_AFTER', '1')),
+                                    on_shed=lambda path: put_count_metric("RequestShed"))
+    gauge_samplers.append(GaugeSampler(metrics, lambda: {"AdmissionLimit": int(admission_limiter.limit),
+                                                         "AdmissionInFlight": admission_limiter.in_flight},
+                                       logger, d, interval=float(os.environ.get('CIRCUIT_STATE_INTERVAL', '10'))))
+# engines are created in the background, the app answers health checks while they warm up
+warm_up_steps = []
+if os.environ.get('STARTUP_WARM_UP', 'true') == 'true':
+    warm_up_steps = [("db_credentials", get_db_credentials_from_cache),
+                     ("pool_sizing", size_pools),
+                     ("db_engines", warm_connection_pools)]
+    if os.environ.get('SYMBOL_CACHE_WARM', 'true') == 'true':
+        warm_up_steps.append(("symbol_cache", warm_symbol_cache))
+
+
+def start_background_threads() -> None:
+    """Start the metrics flusher, gauge samplers, pool monitor, outbox drainer and startup warm-up threads."""
+    metrics.start_background_flusher()
+    for sampler in gauge_samplers:
+        sampler.start()
+    pool_monitor.start()
+    if order_outbox is not None:
+        order_outbox.start()
+    if warm_up_steps:
+        warm_up_in_background(startup_timings, warm_up_steps, logger, d)
+
+
+def post_fork() -> None:
+    """
+    Called by gunicorn.conf.py in each worker forked from a preloaded master. Engines the master created are
+    dropped without closing their connections, which the master still owns, so this worker creates its own pools
+    on first use, and the background threads, which do not survive a fork, are started here.
+    """
+    global db_engine, reader_router
+    if db_engine is not None:
+        db_engine.dispose(close=False)
+    if reader_router is not None:
+        reader_router.stop()
+        for engine in reader_router.engines():
+            engine.dispose(close=False)
+    db_engine = reader_router = None
+    start_background_threads()
+
+
+# a preloaded app starts them in each worker from post_fork instead, gunicorn.conf.py sets this when preloading
+if os.environ.get('BACKGROUND_THREADS_AFTER_FORK', 'false') != 'true':
+    start_background_threads()
 
 
 @app.route("/trade/", methods=["POST"])
 @connection_aware
 def trade():
-    put_count_metric("TradeOrderRequested")
-    json_data = request.get_json()
-    logger.debug("request to trade: {}".format(json_data), extra=d)
-
+    start = time.perf_counter()
     try:
-        with Session(ro_db_engine) as ro_session:
-            symbol_record = current_price(json_data['ticker'], ro_session)
-            logger.debug("symbol_record: {}".format(symbol_record.as_dict()), extra=d)
-            customer = get_customer(json_data['customer_id'], ro_session)
-            logger.debug("current_price: {}".format(json_data['current_price']), extra=d)
-
-        with Session(db_engine) as session:
-            session.expire_on_commit = False
-            activity = place_order(customer=customer,
-                                   symbol=symbol_record,
-                                   json_request=json_data,
-                                   session=session)
-            session.commit()  # idempotent from here forward, db constraint on unique request id. Tested?
-            balance = float(random.randrange(5000, 1000000))
-            cost = symbol_record.close * float(json_data['share_count'])
-
-            logger.debug("current balance: {}, trade cost: {}".format(balance, cost), extra=d)
-
-            circuit_state = CircuitBreakerMonitor.get('execute_trade').state
-            if circuit_state == "closed" \
-                    and float(symbol_record.close) == float(json_data['current_price']) \
-                    and balance > cost:
-                activity.status = TradeState.pending
-                session.commit()
-                # result = retry_call(execute_trade, fargs=[activity.as_dict()], fkwargs={"info": "ip"}, tries=3, backoff=0.2, jitter=0.5)
-                result = execute_trade(activity.as_dict())
-                logger.info("exchange call result: {}".format(result), extra=d)
-
-                activity.status = TradeState.filled
-                session.commit()
+        put_count_metric("TradeOrderRequested")
+        json_data = request.get_json()
+        logger.debug("request to trade: %s", json_data, extra=d)
+        # a retried request id replays the stored outcome, concurrent duplicates share one execution
+        return idempotent_orders.run(json_data['request_id'], functools.partial(place_trade, json_data))
+    finally:
+        trade_latency.record(time.perf_counter() - start)
+
+
+def place_trade(json_data) -> dict:
+    """
+    Look up, place and execute one order, returns the order as_dict().
+    An order whose request_id was already placed, by any process, is answered with the stored order before any
+    other work instead of trading again. One placed concurrently, or not on the reader yet, reserves nothing and
+    conflicts at the insert, and is answered the same way.
+    """
+    with Session(get_ro_db_engine()) as ro_session:
+        replayed = replay_stored(json_data['request_id'], ro_session)
+        if replayed is not None:
+            return replayed
+        customer, symbol_record = get_customer_and_symbol(json_data['customer_id'], json_data['ticker'],
+                                                          ro_session, json_data['current_price'])
+        logger.debug("symbol_record: %s", symbol_record, extra=d)
+        logger.debug("current_price: %s", json_data['current_price'], extra=d)
+
+    with Session(get_db_engine()) as session:
+        cost = symbol_record.close * float(json_data['share_count'])
+        buying = TransactionType(json_data['transaction_type']) == TransactionType.buy
+        balance = customer_ledger.balance(customer)
+        logger.debug("current balance: %s, trade cost: %s", balance, cost, extra=d)
+
+        # decide the initial state up front so the order is persisted with one insert,
+        # a buy only becomes pending once its cost is reserved from the customer balance
+        initial_state = initial_trade_state(symbol_record, json_data, affordable=not buying or balance >= cost)
+        reserved = initial_state == TradeState.pending and buying
+        if order_outbox is not None:
+            if reserved:
+                with tracer.span("balance_reserve"):
+                    if not customer_ledger.reserve(session, customer.id, cost):
+                        reserved, initial_state = False, TradeState.rejected
+            # write-behind, the insert and any state change are written by the outbox drainer
+            try:
+                with tracer.span("insert", state=initial_state.value, mode="outbox"):
+                    activity = order_outbox.open(new_activity(customer, symbol_record, json_data, initial_state),
+                                                 reserved=cost if reserved else 0)
+            except Exception:
+                if reserved:
+                    customer_ledger.release(session, customer.id, cost)
+                raise
+        elif reserved:
+            # one statement reserves the cost and inserts the order, pending or rejected, they commit together
+            with tracer.span("insert", reserve=True) as span:
+                activity, remaining = order_states.open_reserved(
+                    session, new_activity(customer, symbol_record, json_data, initial_state), cost)
+                if span is not None and activity is not None:
+                    span.attributes["state"] = activity.status.value
+            if activity is None:
+                if remaining is not None:
+                    # the order was placed concurrently by another process, it holds its own reservation
+                    customer_ledger.release(session, customer.id, cost)
+                replayed = replay_stored(json_data['request_id'], session)
+                if replayed is None:
+                    raise exc.NoResultFound("order {} was already placed but is not stored".format(
+                        json_data['request_id']))
+                return replayed
+            customer_ledger.record_reservation(customer.id, remaining)
+            reserved, initial_state = activity.status == TradeState.pending, activity.status
+        else:
+            # idempotent from here forward, db constraint on unique request id
+            try:
+                # the insert commits on its own, the order is committed in its initial state when this ends
+                with tracer.span("insert", state=initial_state.value):
+                    activity = place_order(customer=customer,
+                                           symbol=symbol_record,
+                                           json_request=json_data,
+                                           session=session,
+                                           status=initial_state)
+            except exc.IntegrityError:
+                session.rollback()
+                replayed = replay_stored(json_data['request_id'], session)
+                if replayed is None:
+                    raise
+                return replayed
+
+        try:
+            if initial_state == TradeState.pending:
+                with tracer.span("confirms"):
+                    result = execute_trade(activity.as_dict())
+                logger.info("exchange call result: %s", result, extra=d)
+                with tracer.span("final_commit", state=TradeState.filled.value):
+                    move_order(session, activity, TradeState.filled)
                 put_count_metric("TradeOrderFilled")
-            elif circuit_state == "open":
+            elif initial_state == TradeState.aborted:
                 logger.info("Circuit open, aborted because orders cannot be filled.", extra=d)
-                activity.status = TradeState.aborted
-                session.commit()
                 put_count_metric("TradeOrderAborted")
             else:
                 logger.info("Not enough funds to execute trade or invalid price request, rejecting.", extra=d)
-                activity.status = TradeState.rejected
-                session.commit()
                 put_count_metric("TradeOrderRejected")
-    except Exception as e:
-        logger.error(f"Processing failed for {activity}", extra=d)
-        logger.error(e, extra=d)
-        activity.status = TradeState.aborted
-        session.commit()
-        put_count_metric("TradeOrderAborted")
+        except Exception as e:
+            logger.error("Processing failed for %s", activity, extra=d)
+            logger.error(e, extra=d)
+            if activity.status == TradeState.pending:
+                with tracer.span("final_commit", state=TradeState.aborted.value):
+                    move_order(session, activity, TradeState.aborted, refund=cost if reserved else 0)
+            put_count_metric("TradeOrderAborted")
     return activity.as_dict()
 
 
+def replay_stored(request_id: str, session: Session):
+    """
+    The order already placed with request_id as_dict(), returned instead of trading it again, or None.
+    Finished orders come from the idempotency cache, others from one read of the request_id unique index.
+    """
+    order = idempotent_orders.get(request_id)
+    if order is None:
+        with tracer.span("replay_lookup"):
+            stored = idempotent_orders.stored(request_id, session)
+        if stored is None:
+            return None
+        order = stored.as_dict()
+    logger.info("Order %s was already placed, returning it", request_id, extra=d)
+    put_count_metric("TradeOrderReplayed")
+    return order
+
+
+def customer_totals(costs) -> dict:
+    """Sum (customer id, cost) pairs by customer."""
+    totals = {}
+    for customer_id, cost in costs:
+        totals[customer_id] = totals.get(customer_id, 0) + cost
+    return totals
+
+
+@app.route("/trades/", methods=["POST"])
+@connection_aware
+def trades():
+    """
+    Place a batch of orders, such as a portfolio rebalance, in one request: {"orders": [order, ...]} with each
+    order in the /trade/ format. Customers and symbols are read with one IN query each, all orders are inserted
+    with one INSERT ... RETURNING, confirms calls run concurrently, and the outcomes are written with one UPDATE
+    per outcome. Returns {"orders": [...]} in request order, a request id that was already placed returns the
+    stored order instead of trading again, and an order for an unknown customer or ticker returns an error.
+    Placed request ids are looked up first, in the idempotency cache and then with one IN query, so only new
+    orders are read, reserve funds and are written.
+    """
+    orders = (request.get_json() or {}).get("orders")
+    if not orders or len(orders) > trade_batch_max_orders:
+        return {"error": "orders must hold 1 to {} orders".format(trade_batch_max_orders)}, 400
+    metrics.increment("TradeOrderRequested", len(orders))
+    logger.debug("request to trade %s orders: %s", len(orders), orders, extra=d)
+    unique_orders = {}
+    for order in orders:
+        unique_orders.setdefault(order['request_id'], order)
+
+    results = {}
+    for request_id in unique_orders:
+        cached = idempotent_orders.get(request_id)
+        if cached is not None:
+            results[request_id] = cached
+    with Session(get_ro_db_engine()) as ro_session:
+        for activity in idempotent_orders.stored_many([request_id for request_id in unique_orders
+                                                       if request_id not in results], ro_session):
+            results[activity.request_id] = idempotent_orders.put(activity.as_dict())
+        replayed = len(results)
+        unique_orders = {request_id: order for request_id, order in unique_orders.items()
+                         if request_id not in results}
+        customers, symbols = get_customers_and_symbols(list(unique_orders.values()), ro_session) \
+            if unique_orders else ({}, {})
+
+    activities = []
+    costs = {}
+    for request_id, order in unique_orders.items():
+        customer = customers.get(str(order['customer_id']))
+        symbol_record = symbols.get(order['ticker'])
+        if customer is None or symbol_record is None:
+            results[request_id] = {"request_id": request_id, "error": "unknown customer or ticker"}
+            continue
+        cost = symbol_record.close * float(order['share_count'])
+        buying = TransactionType(order['transaction_type']) == TransactionType.buy
+        initial_state = initial_trade_state(symbol_record, order,
+                                            affordable=not buying or customer_ledger.balance(customer) >= cost)
+        activity = new_activity(customer, symbol_record, order, initial_state)
+        if initial_state == TradeState.pending and buying:
+            costs[request_id] = (activity.customer_id, cost)
+        activities.append(activity)
+
+    with Session(get_db_engine()) as session:
+        # the reservations and the inserts commit together, a failure before the commit leaves neither behind
+        with session.begin():
+            # reserve each customer's pending buys all or nothing, one statement for the whole batch
+            reserved = customer_ledger.reserve_many(session, customer_totals(costs.values()), autocommit=False)
+            # only the reservations made here are ever credited back
+            held = {request_id: cost for request_id, cost in costs.items() if cost[0] in reserved}
+            for activity in activities:
+                if activity.request_id in costs and activity.request_id not in held:
+                    activity.status = TradeState.rejected
+            inserted, existing = order_states.open_many(session, activities, autocommit=False)
+            placed = {activity.request_id for activity in inserted}
+            # a request id that was already placed keeps its stored outcome and does not hold a reservation
+            customer_ledger.release_many(session, customer_totals(
+                held[request_id] for request_id in held if request_id not in placed), autocommit=False)
+        pending = [activity for activity in inserted if activity.status == TradeState.pending]
+        refunds = []
+        try:
+            outcomes = list(confirms_executor.map(confirm_order, [activity.as_dict() for activity in pending]))
+            for outcome in (TradeState.filled, TradeState.aborted):
+                moved = [activity for activity, result in zip(pending, outcomes) if result == outcome]
+                for activity in order_states.transition_many(session, moved, outcome):
+                    logger.warning("Order %s changed state concurrently, not %s", activity.request_id,
+                                   outcome.value, extra=d)
+                if outcome == TradeState.aborted:
+                    refunds.extend(held[activity.request_id] for activity in moved if activity.request_id in held)
+        finally:
+            # an order still pending keeps its reservation, an aborted one is credited back even when a later
+            # step failed
+            customer_ledger.release_many(session, customer_totals(refunds))
+
+    for activity in inserted:
+        metrics.increment({TradeState.filled: "TradeOrderFilled",
+                           TradeState.rejected: "TradeOrderRejected"}.get(activity.status, "TradeOrderAborted"))
+    # placed concurrently, or not yet on the reader, these only conflicted at the insert
+    for activity in inserted + existing:
+        results[activity.request_id] = idempotent_orders.put(activity.as_dict())
+    replayed += len(existing)
+    if replayed:
+        metrics.increment("TradeOrderReplayed", replayed)
+    logger.info("Placed %s orders, %s already placed", len(inserted), replayed, extra=d)
+    return {"orders": [results[order['request_id']] for order in orders]}
+
+
 @app.route("/", methods=["GET"])
 def health():
     """
     A simple health check for the load balancers that indicates Flask application is up and running.
+    Answers from memory only, the confirms circuit state is reported by a gauge sampler instead.
     """
-    logger.info("Call to / it's OK", extra=d)
-    state = CircuitBreakerMonitor.get('execute_trade').state
-    if state == "open":
-        put_count_metric(metric_name="ConfirmsCircuitOpen")
-    elif state == "closed":
-        put_count_metric(metric_name="ConfirmsCircuitClosed")
-    else:
-        put_count_metric(metric_name="ConfirmsCircuitUnknown")
-
+    logger.debug("Call to / it's OK", extra=d)
     return "OK"
 
 
@@ -274,8 +823,9 @@ def deep_health():
     A deep health check that confirms the order service can successfully connect to the trade confirms service.
     """
     logger.info("Call to /exchange-health/", extra=d)
-    response = requests.get("http://{}/exchange-health/".format(confirms_endpoint))
-    logger.info(response, extra=d)
+    response = confirms_client.get("/exchange-health/")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s with confirms connections %s", response, confirms_client.stats(), extra=d)
     return Response(response.text, status=response.status_code, mimetype="text/plain")
 
 
@@ -286,10 +836,9 @@ def db_health():
     A database health check that confirms the order service is successfully connecting to the database.
     """
     logger.info("Checking DB connection", extra=d)
-    with Session(db_engine) as session:
-        statement = select(Customer).where(Customer.first_name == "kevin")
-        customer = session.scalars(statement).one()
-    logger.info("Here's your customer: {}".format(customer.as_dict()), extra=d)
+    with Session(get_db_engine()) as session:
+        customer = repository.customer_by_first_name(session, "kevin")
+    logger.info("Here's your customer: %s", customer, extra=d)
     return customer.as_dict()
 
 
@@ -297,14 +846,43 @@ def db_health():
 # @connection_aware
 def db_stress():
     """
-    issue long-running queries to the single writer instance to consume database connections, lead to exhaustion
+    Generate database load from this worker to consume connections, up to exhaustion, and measure it.
+    Query parameters: query, one of select1, sleep (default), customer or symbols; concurrency threads, default 1;
+    duration seconds, default 1, capped by DB_STRESS_MAX_DURATION to stay inside the gunicorn timeout;
+    engine, reader (default) or writer; sleep seconds per pg_sleep, default .1; ids to cycle lookups over.
+    Returns latency, pool wait and query time histograms in milliseconds.
     """
-    logger.info("Stress consuming a DB connection", extra=d)
-    for i in range(1, 25):
-        with (Session(ro_db_engine) as session):
-            result = session.execute(text("select pg_sleep(.1);"))
-            logger.info(f"Stress Query result: {result}", extra=d)
-    return {"result": "slow query complete"}
+    args = request.args
+    engine = get_db_engine() if args.get("engine", "reader") == "writer" else get_ro_db_engine()
+    try:
+        result = load_generator.run(engine, args.get("query", "sleep"), int(args.get("concurrency", "1")),
+                                    float(args.get("duration", "1")), sleep=float(args.get("sleep", ".1")),
+                                    ids=int(args.get("ids", "100")))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    result["engine"] = args.get("engine", "reader")
+    logger.info("Stress %s queries at %s qps, p99 %s ms, pool wait p99 %s ms", result["queries"], result["qps"],
+                result["latency"]["p99_ms"], result["pool_wait"]["p99_ms"], extra=d)
+    return result
+
+
+@app.route("/metrics/latency", methods=["GET"])
+def latency_metrics():
+    """
+    Rolling histograms over the last LATENCY_WINDOW seconds of /trade/ latency and of the wait for a writer and a
+    reader connection, in milliseconds.
+    """
+    return {"window_s": latency_window,
+            "trade": trade_latency.snapshot().as_dict(),
+            "writer_pool_wait": writer_pool_telemetry.histogram.snapshot().as_dict(),
+            "reader_pool_wait": reader_pool_telemetry.histogram.snapshot().as_dict()}
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus exposition of the metrics of every worker of this task."""
+    body, content_type = exposition()
+    return Response(body, content_type=content_type)
 
 
 @app.route("/region-az/", methods=["GET"])
@@ -312,6 +890,23 @@ def region_az():
     return availability_zone_
 
 
+@app.route("/startup/", methods=["GET"])
+def startup():
+    """
+    How long each startup step took in milliseconds, from process start to ready and to fully warm.
+    """
+    return startup_timings.as_dict()
+
+
+# a client sending X-Server-Timing gets the duration of each /trade/ stage in a Server-Timing response header,
+# unless SERVER_TIMING is false
+app.wsgi_app = TracingMiddleware(app.wsgi_app, tracer, paths={"/trade/"},
+                                 server_timing_enabled=os.environ.get('SERVER_TIMING', 'true') == 'true')
+# outermost, so requests shed by admission control are recorded too
+app.wsgi_app = PrometheusMiddleware(app.wsgi_app, routes={rule.rule for rule in app.url_map.iter_rules()})
+startup_timings.mark("ready")
+
+
 if __name__ == "__main__":
     app.run(debug=False, host="0.0.0.0", port=80)
     logger.info("Started Order Flask app", extra=d)
@@ -0,0 +1,371 @@
+#!/bin/python3
+"""
+ASGI entry point for the order API, serving the same routes as order_api.py from an asyncio event loop.
+Database calls use SQLAlchemy asyncio with asyncpg and confirms calls use an async httpx client, so one worker keeps
+many orders in flight instead of blocking on each one.
+Run it with: gunicorn -k uvicorn.workers.UvicornWorker order_api_async:app
+"""
+import asyncio
+import atexit
+import contextlib
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import httpx
+from circuitbreaker import circuit
+from circuitbreaker import CircuitBreakerMonitor
+from circuitbreaker import CircuitBreaker
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.middleware import Middleware
+from starlette.routing import Route
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+from data_objects import Activity, TradeState, TransactionType
+from trade_parameter_name import TradeParameterName
+from metrics import MetricsEmitter, GaugeSampler
+from symbol_cache import SymbolCache
+from repository import OrderRepository
+from order_state import OrderStateEngine
+from idempotency import IdempotentOrders
+from balances import CustomerLedger
+from confirms_retry import RetryBudget, RetryingCaller
+from db_credentials import RotatingCredentials
+from log_config import configure_logging, SampledRequestLogs
+from shared_circuit import SharedCircuitBreaker
+import startup
+
+
+class ConfirmsUnavailableError(RuntimeError):
+    pass
+
+
+class OrderJSONResponse(JSONResponse):
+    """Serializes the datetime and numeric columns in as_dict() results."""
+
+    def render(self, content) -> bytes:
+        return json.dumps(content, default=str).encode("utf-8")
+
+
+CONFIRMS_MAX_CONNECTIONS = 100
+
+logger, log_sampler = configure_logging('orders', sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', '1')))
+
+availability_zone_ = None
+d = {'az': None}
+metrics = None
+confirms_endpoint = None
+confirms_client = None
+confirms_caller = None
+confirms_executor = None
+db_engine = None
+ro_db_engine = None
+order_states = OrderStateEngine()
+repository = OrderRepository()
+customer_ledger = CustomerLedger(ttl=float(os.environ.get('BALANCE_CACHE_TTL', '5')))
+idempotent_orders = IdempotentOrders(max_size=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '4096')))
+startup_timings = startup.StartupTimings()
+symbol_cache = SymbolCache(max_size=int(os.environ.get('SYMBOL_CACHE_SIZE', '1024')),
+                           ttl=float(os.environ.get('SYMBOL_CACHE_TTL', '60')))
+
+
+def load_config() -> dict:
+    """Blocking startup lookups, task metadata, SSM parameters and database credentials, run off the event loop."""
+    task, parameters = startup.load_config(startup_timings, [TradeParameterName.TRADE_ORDER_API_SECRET_ID.value,
+                                                             TradeParameterName.TRADE_CONFIRMS_ENDPOINT.value])
+    cache_config = SecretCacheConfig(max_cache_size=100, secret_refresh_interval=300)
+    secrets_cache = SecretCache(config=cache_config, client=boto3.session.Session().client("secretsmanager"))
+    credentials = RotatingCredentials(lambda: secrets_cache,
+                                      parameters[TradeParameterName.TRADE_ORDER_API_SECRET_ID.value])
+    startup_timings.timed("db_credentials", credentials.current)
+    return {"task": task, "confirms_endpoint": parameters[TradeParameterName.TRADE_CONFIRMS_ENDPOINT.value],
+            "credentials": credentials}
+
+
+def create_engines(credentials: RotatingCredentials) -> None:
+    """
+    Create the read-write and read-only asyncpg engines, same hosts and pool sizes as the sync service.
+    Each new connection gets the current user and password from the secret cache, so a rotation is picked up by the
+    next connection. The cache only calls Secrets Manager once per refresh interval, from the connecting coroutine.
+    asyncpg prepares each statement once per connection and keeps DB_PREPARED_STATEMENT_CACHE_SIZE of them, set it
+    to 0 through RDS Proxy, which pins a connection that holds prepared statements.
+    """
+    global db_engine, ro_db_engine
+    secret = credentials.current()
+    host_ = secret['host']
+    ro_host_ = secret['host'].replace("stock.cluster", "stock.cluster-ro")
+    statement_cache_size = int(os.environ.get('DB_PREPARED_STATEMENT_CACHE_SIZE', '100'))
+    db_engine = create_async_engine(
+        f"postgresql+asyncpg://{host_}:{secret['port']}/{secret['dbname']}", pool_size=10,
+        connect_args={"ssl": "require", "server_settings": {"statement_timeout": "100"},
+                      "prepared_statement_cache_size": statement_cache_size})
+    ro_db_engine = create_async_engine(
+        f"postgresql+asyncpg://{ro_host_}:{secret['port']}/{secret['dbname']}", pool_size=10,
+        connect_args={"ssl": "require", "prepared_statement_cache_size": statement_cache_size})
+    for engine in (db_engine, ro_db_engine):
+        event.listen(engine.sync_engine, "do_connect", credentials.inject)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global availability_zone_, metrics, confirms_endpoint, confirms_client, confirms_caller, confirms_executor
+    config = await asyncio.to_thread(load_config)
+    logger.info(config["task"])
+    availability_zone_ = config["task"]['AvailabilityZone']
+    d['az'] = availability_zone_
+    metrics_mode = os.environ.get('METRICS_MODE', 'emf')
+    metrics = MetricsEmitter(namespace="TradeOrder", dimension_name="AvailabilityZone",
+                             dimension_value=availability_zone_, logger=logger,
+                             cw_client=boto3.client('cloudwatch') if metrics_mode == 'put_metric_data' else None,
+                             flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', '10')), log_extra=d)
+    metrics.start_background_flusher()
+    atexit.register(metrics.stop)
+    circuit_state_sampler = GaugeSampler(metrics, circuit_state_gauges, logger, d,
+                                         interval=float(os.environ.get('CIRCUIT_STATE_INTERVAL', '10')))
+    circuit_state_sampler.start()
+    confirms_endpoint = config["confirms_endpoint"]
+    read_timeout = float(os.environ.get('CONFIRMS_READ_TIMEOUT', '.3'))
+    connect_timeout = float(os.environ.get('CONFIRMS_CONNECT_TIMEOUT', '.1'))
+    confirms_client = httpx.AsyncClient(
+        base_url="http://{}".format(confirms_endpoint),
+        limits=httpx.Limits(max_connections=CONFIRMS_MAX_CONNECTIONS,
+                            max_keepalive_connections=int(os.environ.get('CONFIRMS_POOL_SIZE', '10'))),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+    # the same retry budget, deadline and hedging as order_api.py, one thread per confirms connection waits for the
+    # attempts of an order, which run on the event loop
+    confirms_caller = RetryingCaller(RetryBudget(ratio=float(os.environ.get('CONFIRMS_RETRY_BUDGET_RATIO', '.1'))),
+                                     should_retry=retryable_confirms_error, metrics=metrics,
+                                     max_attempts=int(os.environ.get('CONFIRMS_MAX_ATTEMPTS', '3')),
+                                     attempt_timeout=read_timeout + connect_timeout,
+                                     deadline=float(os.environ.get('CONFIRMS_DEADLINE', '1')),
+                                     hedging=os.environ.get('CONFIRMS_HEDGING', 'false') == 'true',
+                                     hedge_percentile=float(os.environ.get('CONFIRMS_HEDGE_PERCENTILE', '95')),
+                                     hedge_workers=int(os.environ.get('CONFIRMS_POOL_SIZE', '10')))
+    confirms_executor = ThreadPoolExecutor(max_workers=CONFIRMS_MAX_CONNECTIONS, thread_name_prefix="confirms")
+    create_engines(config["credentials"])
+    startup_timings.mark("ready")
+    logger.info("Started Order ASGI app, startup timings in ms: %s", startup_timings.as_dict(), extra=d)
+    yield
+    confirms_executor.shutdown(wait=False)
+    await confirms_client.aclose()
+    await db_engine.dispose()
+    await ro_db_engine.dispose()
+
+
+def put_count_metric(metric_name: str):
+    metrics.increment(metric_name)
+
+
+async def get_customer_and_symbol(customer_id: str, ticker: str, session: AsyncSession, expected_price=None) -> tuple:
+    """Async version of the single round trip customer and symbol lookup in order_api.py, same statements."""
+    symbol_record = symbol_cache.get(ticker)
+    if symbol_record is not None and (expected_price is None or float(symbol_record.close) == float(expected_price)):
+        return await session.run_sync(repository.customer, customer_id), symbol_record
+
+    customer_record, symbol_record = await session.run_sync(repository.customer_and_symbol, customer_id, ticker)
+    session.expunge(symbol_record)
+    return customer_record, symbol_cache.put(symbol_record)
+
+
+async def confirm_trade(activity: dict) -> httpx.Response:
+    """One call to the confirms service."""
+    response = await confirms_client.post("/confirm-trade/", json=activity)
+    logger.info("response: %s for %s", response.status_code, response.reason_phrase, extra=d)
+    if "ConfirmsMaintenanceError" in response.text:
+        raise ConfirmsUnavailableError(response.text)  # triggers circuit breaker
+    response.raise_for_status()  # triggers retries
+    return response
+
+
+def retryable_confirms_error(error: Exception) -> bool:
+    """Timeouts, dropped connections and 5xx answers are worth another attempt, exchange maintenance is not."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+@circuit(failure_threshold=5, expected_exception=ConfirmsUnavailableError, recovery_timeout=60, name="execute_trade",
+         cls=SharedCircuitBreaker if os.environ.get('CIRCUIT_SHARED', 'true') == 'true' else CircuitBreaker)
+async def execute_trade(activity: dict) -> httpx.Response:
+    """
+    Confirm an order through confirms_caller, so retries and hedges are paced exactly as in order_api.py.
+    The caller blocks between attempts, so it runs on confirms_executor and each attempt is awaited on the loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    def attempt() -> httpx.Response:
+        return asyncio.run_coroutine_threadsafe(confirm_trade(activity), loop).result()
+
+    return await loop.run_in_executor(confirms_executor, confirms_caller.call, attempt)
+
+
+def circuit_state_gauges() -> dict:
+    """One gauge per confirms circuit state, 1 for the current state and 0 for the others."""
+    state = CircuitBreakerMonitor.get('execute_trade').state
+    return {"ConfirmsCircuitOpen": int(state == "open"),
+            "ConfirmsCircuitClosed": int(state == "closed"),
+            "ConfirmsCircuitUnknown": int(state not in ("open", "closed"))}
+
+
+async def trade(request: Request) -> Response:
+    put_count_metric("TradeOrderRequested")
+    json_data = await request.json()
+    logger.debug("request to trade: %s", json_data, extra=d)
+    # a retried request id replays the stored outcome, concurrent duplicates share one execution
+    return OrderJSONResponse(await idempotent_orders.run_async(json_data['request_id'],
+                                                               functools.partial(place_trade, json_data)))
+
+
+async def place_trade(json_data) -> dict:
+    """
+    Async version of place_trade in order_api.py, returns the order as_dict(). An order whose request_id was
+    already placed is answered with the stored order before any other work. A buy reserves its cost in the
+    statement that inserts it and an aborted buy is credited back in the statement that moves it.
+    """
+    async with AsyncSession(ro_db_engine) as ro_session:
+        replayed = await replay_stored(json_data['request_id'], ro_session)
+        if replayed is not None:
+            return replayed
+        customer, symbol_record = await get_customer_and_symbol(json_data['customer_id'], json_data['ticker'],
+                                                                ro_session, json_data['current_price'])
+
+    async with AsyncSession(db_engine) as session:
+        cost = symbol_record.close * float(json_data['share_count'])
+        buying = TransactionType(json_data['transaction_type']) == TransactionType.buy
+        circuit_state = CircuitBreakerMonitor.get('execute_trade').state
+        if circuit_state == "closed" \
+                and float(symbol_record.close) == float(json_data['current_price']) \
+                and (not buying or customer_ledger.balance(customer) >= cost):
+            initial_state = TradeState.pending
+        elif circuit_state == "open":
+            initial_state = TradeState.aborted
+        else:
+            initial_state = TradeState.rejected
+        reserved = initial_state == TradeState.pending and buying
+
+        activity = Activity(customer_id=customer.id, symbol_ticker=symbol_record.id, status=initial_state,
+                            type=TransactionType(json_data["transaction_type"]),
+                            share_count=json_data["share_count"], current_price=json_data["current_price"],
+                            request_id=json_data["request_id"])
+        if reserved:
+            # one statement reserves the cost and inserts the order, pending or rejected, they commit together
+            activity, remaining = await session.run_sync(order_states.open_reserved, activity, cost)
+            if activity is None:
+                if remaining is not None:
+                    # the order was placed concurrently by another process, it holds its own reservation
+                    await session.run_sync(customer_ledger.release, customer.id, cost)
+                replayed = await replay_stored(json_data['request_id'], session)
+                if replayed is None:
+                    raise exc.NoResultFound("order {} was already placed but is not stored".format(
+                        json_data['request_id']))
+                return replayed
+            customer_ledger.record_reservation(customer.id, remaining)
+            reserved, initial_state = activity.status == TradeState.pending, activity.status
+        else:
+            # idempotent from here forward, db constraint on unique request id
+            try:
+                await session.run_sync(order_states.open, activity)
+            except exc.IntegrityError:
+                await session.rollback()
+                replayed = await replay_stored(json_data['request_id'], session)
+                if replayed is None:
+                    raise
+                return replayed
+
+        try:
+            if initial_state == TradeState.pending:
+                result = await execute_trade(activity.as_dict())
+                logger.info("exchange call result: %s", result, extra=d)
+                await session.run_sync(order_states.transition, activity, TradeState.filled)
+                put_count_metric("TradeOrderFilled")
+            elif initial_state == TradeState.aborted:
+                logger.info("Circuit open, aborted because orders cannot be filled.", extra=d)
+                put_count_metric("TradeOrderAborted")
+            else:
+                logger.info("Not enough funds to execute trade or invalid price request, rejecting.", extra=d)
+                put_count_metric("TradeOrderRejected")
+        except Exception as e:
+            logger.error("Processing failed for %s", activity, extra=d)
+            logger.error(e, extra=d)
+            if activity.status == TradeState.pending:
+                await session.run_sync(order_states.transition, activity, TradeState.aborted,
+                                       cost if reserved else 0)
+                if reserved:
+                    customer_ledger.invalidate(activity.customer_id)
+            put_count_metric("TradeOrderAborted")
+    return activity.as_dict()
+
+
+async def replay_stored(request_id: str, session: AsyncSession):
+    """
+    The order already placed with request_id as_dict(), returned instead of trading it again, or None.
+    Finished orders come from the idempotency cache, others from one read of the request_id unique index.
+    """
+    order = idempotent_orders.get(request_id)
+    if order is None:
+        def stored(sync_session):
+            activity = idempotent_orders.stored(request_id, sync_session)
+            return activity.as_dict() if activity is not None else None
+
+        order = await session.run_sync(stored)
+        if order is None:
+            return None
+    logger.info("Order %s was already placed, returning it", request_id, extra=d)
+    put_count_metric("TradeOrderReplayed")
+    return order
+
+
+async def health(request: Request) -> Response:
+    """
+    A simple health check for the load balancers that indicates the ASGI application is up and running.
+    Answers from memory only, the confirms circuit state is reported by circuit_state_sampler instead.
+    """
+    logger.debug("Call to / it's OK", extra=d)
+    return PlainTextResponse("OK")
+
+
+async def deep_health(request: Request) -> Response:
+    """
+    A deep health check that confirms the order service can successfully connect to the trade confirms service.
+    """
+    logger.info("Call to /exchange-health/", extra=d)
+    response = await confirms_client.get("/exchange-health/")
+    logger.info(response, extra=d)
+    return PlainTextResponse(response.text, status_code=response.status_code)
+
+
+async def db_health(request: Request) -> Response:
+    """
+    A database health check that confirms the order service is successfully connecting to the database.
+    """
+    logger.info("Checking DB connection", extra=d)
+    async with AsyncSession(db_engine) as session:
+        customer = await session.run_sync(repository.customer_by_first_name, "kevin")
+    logger.info("Here's your customer: %s", customer, extra=d)
+    return OrderJSONResponse(customer.as_dict())
+
+
+async def region_az(request: Request) -> Response:
+    return PlainTextResponse(availability_zone_)
+
+
+async def startup_report(request: Request) -> Response:
+    """
+    How long each startup step took in milliseconds.
+    """
+    return OrderJSONResponse(startup_timings.as_dict())
+
+
+app = Starlette(routes=[
+    Route("/trade/", trade, methods=["POST"]),
+    Route("/", health, methods=["GET"]),
+    Route("/exchange-health/", deep_health, methods=["GET"]),
+    Route("/db-health/", db_health, methods=["GET"]),
+    Route("/region-az/", region_az, methods=["GET"]),
+    Route("/startup/", startup_report, methods=["GET"]),
+], middleware=[Middleware(SampledRequestLogs, sampler=log_sampler)], lifespan=lifespan)
@@ -0,0 +1,176 @@
+from sqlalchemy import bindparam, case, cast, select, update
+from sqlalchemy.dialects.postgresql import ENUM, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from data_objects import Activity, Customer, TradeState, TransactionType
+from repository import OrderRepository
+
+# the trade_state type of schema.sql, for a state computed in SQL rather than bound as a parameter
+TRADE_STATE = ENUM(*[state.value for state in TradeState], name="trade_state", create_type=False)
+
+
+class InvalidStateTransition(RuntimeError):
+    pass
+
+
+class OrderStateEngine:
+    """
+    Persists trade order state with as few writer round trips as possible.
+    An order is inserted directly in the state decided before the insert, pending when it will be sent to the
+    exchange, rejected or aborted otherwise, instead of committing submitted first and updating it afterwards.
+    A pending order reaches its outcome with one conditional UPDATE ... RETURNING, so a filled order costs two
+    writer round trips and a rejected or aborted order costs one. A buy reserves its cost from the customer balance
+    in the statement that inserts it, and an aborted buy is credited back in the statement that moves it.
+    Both writes run as single statement autocommit transactions, which saves the separate BEGIN and COMMIT round
+    trips, and the unique constraint on request_id still fails a duplicate order at the insert.
+    """
+    TRANSITIONS = {
+        TradeState.submitted: {TradeState.pending, TradeState.rejected, TradeState.aborted},
+        TradeState.pending: {TradeState.filled, TradeState.rejected, TradeState.aborted},
+        TradeState.filled: set(),
+        TradeState.rejected: set(),
+        TradeState.aborted: set(),
+    }
+    INITIAL_STATES = {TradeState.submitted, TradeState.pending, TradeState.rejected, TradeState.aborted}
+
+    # WITH reservation AS (UPDATE customer ... WHERE balance >= cost AND the request id is not placed
+    #                      RETURNING balance),
+    #      inserted AS (INSERT INTO activity ... pending if reserved else rejected ... RETURNING id)
+    # SELECT (SELECT id FROM inserted), (SELECT balance FROM reservation)
+    _reservation = update(Customer) \
+        .where(Customer.id == bindparam("customer_id"), Customer.balance >= bindparam("cost"),
+               ~select(Activity.id).where(Activity.request_id == bindparam("request_id")).exists()) \
+        .values(balance=Customer.balance - bindparam("cost")) \
+        .returning(Customer.balance) \
+        .cte("reservation")
+    _inserted = insert(Activity) \
+        .values(request_id=bindparam("request_id"), customer_id=bindparam("customer_id"),
+                symbol_ticker=bindparam("symbol_ticker"), type=bindparam("type"),
+                current_price=bindparam("current_price"), share_count=bindparam("share_count"),
+                status=cast(case((select(_reservation.c.balance).exists(), TradeState.pending.value),
+                                 else_=TradeState.rejected.value), TRADE_STATE)) \
+        .on_conflict_do_nothing(index_elements=[Activity.request_id]) \
+        .returning(Activity.id) \
+        .cte("inserted")
+    OPEN_RESERVED = select(select(_inserted.c.id).scalar_subquery(),
+                           select(_reservation.c.balance).scalar_subquery())
+
+    def __init__(self):
+        self.repository = OrderRepository()
+
+    @staticmethod
+    def _autocommit(session: Session) -> None:
+        session.connection(execution_options={"isolation_level": "AUTOCOMMIT"})
+
+    def open(self, session: Session, activity: Activity) -> Activity:
+        """Insert a new order in its initial state with a single INSERT ... RETURNING id."""
+        if activity.status not in self.INITIAL_STATES:
+            raise InvalidStateTransition("orders cannot start as {}".format(activity.status))
+        self._autocommit(session)
+        session.expire_on_commit = False
+        session.add(activity)
+        session.commit()
+        return activity
+
+    def open_reserved(self, session: Session, activity: Activity, cost: float) -> tuple:
+        """
+        Insert a buy and reserve its cost from the customer balance with one statement, pending when the balance
+        covers the cost and rejected otherwise. The reservation and the insert commit together, so a failure of
+        either leaves nothing behind, and nothing is reserved for a request id that was already placed.
+        Returns (activity, remaining balance): activity is None when the request id was already placed, and the
+        remaining balance is None when nothing was reserved. An order placed concurrently with the same request id
+        is only seen by the insert, a reservation made for it is the caller's to credit back.
+        """
+        self._autocommit(session)
+        order_id, remaining = session.execute(self.OPEN_RESERVED, {
+            "request_id": activity.request_id, "customer_id": activity.customer_id,
+            "symbol_ticker": activity.symbol_ticker, "type": TransactionType(activity.type).value,
+            "current_price": activity.current_price, "share_count": activity.share_count, "cost": cost}).one()
+        session.commit()
+        if order_id is None:
+            return None, remaining
+        activity.id = order_id
+        activity.status = TradeState.pending if remaining is not None else TradeState.rejected
+        return activity, remaining
+
+    def open_many(self, session: Session, activities: list, autocommit: bool = True) -> tuple:
+        """
+        Insert a batch of new orders with one INSERT ... ON CONFLICT (request_id) DO NOTHING RETURNING.
+        Returns (inserted, existing): the inserted orders, and the stored orders for request ids that were already
+        placed, read back with one IN query, so a replayed batch returns the original outcomes.
+        With autocommit False both statements join the transaction of the session, which the caller commits.
+        """
+        for activity in activities:
+            if activity.status not in self.INITIAL_STATES:
+                raise InvalidStateTransition("orders cannot start as {}".format(activity.status))
+        if autocommit:
+            self._autocommit(session)
+        session.expire_on_commit = False
+        rows = [{"request_id": a.request_id, "customer_id": a.customer_id, "symbol_ticker": a.symbol_ticker,
+                 "type": a.type, "status": a.status, "current_price": a.current_price, "share_count": a.share_count}
+                for a in activities]
+        statement = insert(Activity).on_conflict_do_nothing(index_elements=[Activity.request_id]).returning(Activity)
+        inserted = list(session.scalars(statement, rows)) if rows else []
+        placed = {activity.request_id for activity in inserted}
+        replayed = [activity.request_id for activity in activities if activity.request_id not in placed]
+        existing = self.repository.activities(session, replayed) if replayed else []
+        if autocommit:
+            session.commit()
+        return inserted, existing
+
+    def transition(self, session: Session, activity: Activity, new_state: TradeState, refund: float = 0) -> Activity:
+        """
+        Move an order to a new state with one conditional UPDATE ... RETURNING.
+        The update only applies while the row is still in the state this process last saw, so a concurrent
+        transition is detected instead of overwritten. A refund is credited back to the customer in the same
+        statement, only when the order moved, so it is neither lost nor paid twice.
+        """
+        current_state = TradeState(activity.status)
+        if new_state not in self.TRANSITIONS[current_state]:
+            raise InvalidStateTransition("cannot move order {} from {} to {}".format(
+                activity.request_id, current_state.value, new_state.value))
+        self._autocommit(session)
+        statement = update(Activity) \
+            .where(Activity.id == activity.id, Activity.status == current_state) \
+            .values(status=new_state) \
+            .returning(Activity.status) \
+            .execution_options(synchronize_session=False)
+        if refund:
+            moved = statement.cte("moved")
+            statement = update(Customer) \
+                .where(Customer.id == activity.customer_id, select(moved.c.status).exists()) \
+                .values(balance=Customer.balance + refund) \
+                .returning(select(moved.c.status).scalar_subquery()) \
+                .execution_options(synchronize_session=False)
+        persisted = session.execute(statement).scalar_one_or_none()
+        session.commit()
+        if persisted is None:
+            raise InvalidStateTransition("order {} is no longer {}".format(activity.request_id, current_state.value))
+        set_committed_value(activity, "status", TradeState(persisted))
+        return activity
+
+    def transition_many(self, session: Session, activities: list, new_state: TradeState) -> list:
+        """
+        Move orders that share a current state to the same new state with one conditional UPDATE ... RETURNING.
+        Returns the orders that were not moved because a concurrent transition got there first.
+        """
+        if not activities:
+            return []
+        current_state = TradeState(activities[0].status)
+        if any(TradeState(activity.status) != current_state for activity in activities):
+            raise InvalidStateTransition("orders in a batch transition must share a state")
+        if new_state not in self.TRANSITIONS[current_state]:
+            raise InvalidStateTransition("cannot move orders from {} to {}".format(current_state.value,
+                                                                                   new_state.value))
+        self._autocommit(session)
+        statement = update(Activity) \
+            .where(Activity.id.in_([activity.id for activity in activities]), Activity.status == current_state) \
+            .values(status=new_state) \
+            .returning(Activity.id) \
+            .execution_options(synchronize_session=False)
+        moved = set(session.scalars(statement))
+        session.commit()
+        for activity in activities:
+            if activity.id in moved:
+                set_committed_value(activity, "status", new_state)
+        return [activity for activity in activities if activity.id not in moved]
@@ -0,0 +1,270 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import exc, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from balances import CustomerLedger
+from data_objects import Activity, TradeState, TransactionType
+from order_state import OrderStateEngine, InvalidStateTransition
+
+
+class InvalidOrder(ValueError):
+    pass
+
+
+class FileQueue:
+    """
+    A durable local stand-in for a message queue such as SQS. Records are appended as JSON lines to an open segment
+    file of this process, flushed, and fsynced unless fsync is False, before append returns.
+    seal() renames the open segment to a ready one; ready() lists the ready segments of this process, and adopts
+    the open and ready segments of processes that are no longer running, such as a worker gunicorn restarted, by
+    renaming them, so exactly one process drains each segment. Segments are oldest first within a process.
+    dead_letter() moves a segment that cannot be written to the dead-letter subdirectory, out of the queue; move it
+    back to the queue directory to write it again.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.directory = directory
+        self.fsync = fsync
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_path(self, pid: int) -> str:
+        return os.path.join(self.directory, "outbox-{}.open".format(pid))
+
+    def _ready_path(self, pid: int) -> str:
+        return os.path.join(self.directory, "outbox-{}-{:020d}.ready".format(pid, time.time_ns()))
+
+    def append(self, record: dict) -> None:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            # a forked worker writes its own segment, never the one of its parent
+            if self._pid != os.getpid():
+                self._file, self._pid = open(self._open_path(os.getpid()), "a"), os.getpid()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def seal(self) -> None:
+        with self._lock:
+            if self._pid != os.getpid() or self._file.tell() == 0:
+                return
+            self._file.close()
+            self._file = None
+            self._pid = None
+            os.rename(self._open_path(os.getpid()), self._ready_path(os.getpid()))
+
+    @staticmethod
+    def _running(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def ready(self) -> list:
+        pid = os.getpid()
+        for path in sorted(glob.glob(os.path.join(self.directory, "outbox-*"))):
+            owner = int(os.path.basename(path).split(".")[0].split("-")[1])
+            if owner != pid and not self._running(owner):
+                try:
+                    os.rename(path, self._ready_path(pid))
+                except FileNotFoundError:
+                    pass  # another process adopted it first
+        return sorted(glob.glob(os.path.join(self.directory, "outbox-{}-*.ready".format(pid))))
+
+    @staticmethod
+    def read(path: str) -> list:
+        with open(path) as segment:
+            # a line cut short by a crash mid append was never acknowledged, skip it
+            return [json.loads(line) for line in segment if line.endswith("\n")]
+
+    @staticmethod
+    def done(path: str) -> None:
+        os.remove(path)
+
+    def dead_letter(self, path: str) -> str:
+        dead_letters = os.path.join(self.directory, "dead-letter")
+        os.makedirs(dead_letters, exist_ok=True)
+        dead_path = os.path.join(dead_letters, os.path.basename(path))
+        os.rename(path, dead_path)
+        return dead_path
+
+
+class OrderOutbox:
+    """
+    Write-behind for single orders. open() and transition() append the new order row, or its state change, to a
+    durable queue and return without a writer round trip; a daemon thread drains the queue every interval seconds
+    and writes each sealed segment in one transaction: one INSERT ... ON CONFLICT (request_id) DO NOTHING executed
+    for all of its orders, one conditional UPDATE per kind of state change, and one balance update crediting back
+    reservations. Under writer pressure orders keep being accepted while the segments wait, and a segment that
+    fails is retried whole on the next interval, before any later segment so state changes stay in order.
+    Errors reaching the database are retried until it is back; a segment that fails max_attempts times for any
+    other reason, such as a row the database rejects, is moved to the dead letters so the segments after it are
+    written. open() rejects an order the database would, so one bad order does not fail its whole segment.
+    An order is not visible in the database, and has no id, until its segment is written. place_trade looks every
+    request_id up before any other work; one placed concurrently by another process, or not yet written or on the
+    reader, is only detected when its segment is written: the new order is dropped, its reservation credited back
+    and its later state changes ignored, but it has been sent to the exchange.
+    """
+
+    def __init__(self, queue: FileQueue, get_engine, ledger: CustomerLedger, logger: logging.Logger,
+                 extra: dict = None, interval: float = .05, duplicates: int = 65536, max_attempts: int = 5):
+        self.queue = queue
+        self.get_engine = get_engine
+        self.ledger = ledger
+        self.logger = logger
+        self.extra = extra or {}
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.appended = 0
+        self.written = 0
+        self.dead_letters = 0  # records in segments moved to the dead letters
+        self._attempts = {}
+        self._max_duplicates = duplicates
+        self._duplicates = OrderedDict()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def backlog(self) -> int:
+        """Records appended by this process that are not written or moved to the dead letters yet."""
+        return max(self.appended - self.written - self.dead_letters, 0)
+
+    def _append(self, record: dict) -> None:
+        self.queue.append(record)
+        self.appended += 1
+
+    @staticmethod
+    def validate(activity: Activity) -> None:
+        """Raise InvalidOrder for an order the activity table would reject, as its segment is written later."""
+        if not activity.request_id or len(activity.request_id) > 40:
+            raise InvalidOrder("request_id must be 1 to 40 characters")
+        if activity.customer_id is None or activity.symbol_ticker is None:
+            raise InvalidOrder("order {} has no customer or symbol".format(activity.request_id))
+        if not float(activity.share_count) > 0 or not float(activity.current_price) > 0:
+            raise InvalidOrder("order {} needs a positive share count and price".format(activity.request_id))
+
+    def open(self, activity: Activity, reserved: float = 0) -> Activity:
+        """Queue the insert of a new order, reserved is the cost already reserved from the customer balance."""
+        if activity.status not in OrderStateEngine.INITIAL_STATES:
+            raise InvalidStateTransition("orders cannot start as {}".format(activity.status))
+        self.validate(activity)
+        order = {"request_id": activity.request_id, "customer_id": activity.customer_id,
+                 "symbol_ticker": activity.symbol_ticker, "type": TransactionType(activity.type).value,
+                 "status": TradeState(activity.status).value, "current_price": activity.current_price,
+                 "share_count": activity.share_count}
+        self._append({"op": "open", "order": order, "reserved": reserved})
+        return activity
+
+    def transition(self, activity: Activity, new_state: TradeState, refund: float = 0) -> Activity:
+        """Queue a state change of an order, refund is credited back to the customer once it is written."""
+        current_state = TradeState(activity.status)
+        if new_state not in OrderStateEngine.TRANSITIONS[current_state]:
+            raise InvalidStateTransition("cannot move order {} from {} to {}".format(
+                activity.request_id, current_state.value, new_state.value))
+        self._append({"op": "move", "request_id": activity.request_id, "customer_id": activity.customer_id,
+                      "from": current_state.value, "to": new_state.value, "refund": refund})
+        activity.status = new_state
+        return activity
+
+    def _write(self, session: Session, records: list) -> set:
+        """Write one segment in the transaction of session, returns the request ids that were already placed."""
+        rows = [dict(record["order"], type=TransactionType(record["order"]["type"]),
+                     status=TradeState(record["order"]["status"]))
+                for record in records if record["op"] == "open"]
+        statement = insert(Activity).on_conflict_do_nothing(index_elements=[Activity.request_id]) \
+            .returning(Activity.request_id)
+        inserted = set(session.scalars(statement, rows)) if rows else set()
+        duplicates = {row["request_id"] for row in rows} - inserted
+
+        refunds = {}
+        moves = {}
+        for record in records:
+            if record["op"] == "open" and record["order"]["request_id"] in duplicates and record["reserved"]:
+                customer_id = record["order"]["customer_id"]
+                refunds[customer_id] = refunds.get(customer_id, 0) + record["reserved"]
+            elif record["op"] == "move" and record["request_id"] not in duplicates \
+                    and record["request_id"] not in self._duplicates:
+                moves.setdefault((record["from"], record["to"]), []).append(record)
+        for (current_state, new_state), moving in moves.items():
+            statement = update(Activity) \
+                .where(Activity.request_id.in_([record["request_id"] for record in moving]),
+                       Activity.status == TradeState(current_state)) \
+                .values(status=TradeState(new_state)) \
+                .returning(Activity.request_id) \
+                .execution_options(synchronize_session=False)
+            moved = set(session.scalars(statement))
+            for record in moving:
+                if record["request_id"] not in moved:
+                    self.logger.warning("Order %s changed state concurrently, not %s", record["request_id"],
+                                        new_state, extra=self.extra)
+                elif record["refund"]:
+                    refunds[record["customer_id"]] = refunds.get(record["customer_id"], 0) + record["refund"]
+        self.ledger.release_many(session, refunds, autocommit=False)
+        return duplicates
+
+    def drain(self) -> int:
+        """Write every sealed segment, oldest first, returns the number of records written."""
+        self.queue.seal()
+        written = 0
+        for path in self.queue.ready():
+            records = []
+            try:
+                records = self.queue.read(path)
+                with Session(self.get_engine()) as session, session.begin():
+                    duplicates = self._write(session, records)
+            except (exc.OperationalError, exc.InterfaceError, exc.TimeoutError):
+                raise
+            except Exception as e:
+                self._attempts[path] = self._attempts.get(path, 0) + 1
+                if self._attempts[path] < self.max_attempts:
+                    raise
+                del self._attempts[path]
+                self.dead_letters += len(records)
+                self.logger.error("Outbox segment failed %s times, moved to %s: %s", self.max_attempts,
+                                  self.queue.dead_letter(path), e, extra=self.extra)
+                continue
+            self._attempts.pop(path, None)
+            self.queue.done(path)
+            for request_id in duplicates:
+                self.logger.warning("Order %s was already placed, dropped", request_id, extra=self.extra)
+                self._duplicates[request_id] = True
+            while len(self._duplicates) > self._max_duplicates:
+                self._duplicates.popitem(last=False)
+            written += len(records)
+        # adopted segments of other processes can make this run ahead of appended, backlog is only a gauge
+        self.written = min(self.appended, self.written + written)
+        return written
+
+    def start(self) -> None:
+        def run():
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.drain()
+                except Exception as e:
+                    self.logger.warning("Outbox drain failed, retrying: %s", e, extra=self.extra)
+
+        self._thread = threading.Thread(target=run, name="outbox-drainer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the drainer and write what is left; segments that still fail are adopted after this process exits."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.drain()
+        except Exception as e:
+            self.logger.warning("Outbox drain at exit failed, leaving segments for another worker: %s", e,
+                                extra=self.extra)
@@ -0,0 +1,62 @@
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, REGISTRY, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+
+# seconds, around the 100 ms statement timeout and up to the gunicorn timeout
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .15, .2, .3, .5, .75, 1.0, 1.5, 2.0, 5.0)
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Request latency by route", ["route", "method", "status"],
+                            buckets=LATENCY_BUCKETS)
+# live workers only, the gauge files of a dead worker are removed by the child_exit hook in gunicorn.conf.py
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being served by route", ["route"],
+                           multiprocess_mode="livesum")
+EVENTS = Counter("events", "Occurrences of the counts sent to CloudWatch, such as TradeOrderFilled or ConfirmsRetry",
+                 ["name"])
+
+
+def registry() -> CollectorRegistry:
+    """
+    The registry to expose. Under gunicorn with PROMETHEUS_MULTIPROC_DIR set, every worker writes its samples to
+    memory mapped files in that directory and a scrape of any worker aggregates all of them; otherwise the
+    registry of this process.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def exposition() -> tuple:
+    """The body and content type of a /metrics response."""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+class PrometheusMiddleware:
+    """
+    WSGI middleware that records request latency and in-flight requests by route. Paths outside routes are
+    recorded as "other", so unknown URLs cannot grow the number of series.
+    """
+
+    def __init__(self, app, routes: set):
+        self.app = app
+        self.routes = routes
+
+    def __call__(self, environ, start_response):
+        route = environ.get("PATH_INFO") if environ.get("PATH_INFO") in self.routes else "other"
+        status = []
+
+        def recording_start_response(response_status, headers, exc_info=None):
+            status.append(response_status.split(" ", 1)[0])
+            return start_response(response_status, headers, exc_info)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(route)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            return self.app(environ, recording_start_response)
+        finally:
+            in_flight.dec()
+            REQUEST_LATENCY.labels(route, environ.get("REQUEST_METHOD"), status[0] if status else "500") \
+                .observe(time.perf_counter() - start)
@@ -0,0 +1,144 @@
+import logging
+import threading
+import boto3
+from sqlalchemy import text
+
+# replica lag of each reader as seen by the instance the query runs on, server_id is the DB instance identifier
+REPLICA_LAG = text("select server_id, replica_lag_in_msec from aurora_replica_status() "
+                   "where session_id <> 'MASTER_SESSION_ID'")
+
+
+class ReaderEndpoint:
+    """One reader instance, or the read-only proxy endpoint, with its engine created on first use."""
+
+    def __init__(self, name: str, host: str, availability_zone: str = None):
+        self.name = name
+        self.host = host
+        self.availability_zone = availability_zone
+        self.lag_ms = None
+        self.engine = None
+
+    def in_use(self) -> int:
+        return self.engine.pool.checkedout() if self.engine is not None else 0
+
+
+class ReaderPools:
+    """The reader pools seen as one pool, for PoolTelemetry.publish."""
+
+    def __init__(self, endpoints: list):
+        self._pools = [endpoint.engine.pool for endpoint in endpoints if endpoint.engine is not None]
+
+    def size(self) -> int:
+        return sum(pool.size() for pool in self._pools)
+
+    def checkedout(self) -> int:
+        return sum(pool.checkedout() for pool in self._pools)
+
+    def checkedin(self) -> int:
+        return sum(pool.checkedin() for pool in self._pools)
+
+    def overflow(self) -> int:
+        return sum(max(pool.overflow(), 0) for pool in self._pools)
+
+
+def discover_readers(cluster_id: str) -> list:
+    """The reader instances of an Aurora cluster with their endpoint and availability zone, from the RDS API."""
+    rds_client = boto3.client('rds')
+    members = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_id)['DBClusters'][0]['DBClusterMembers']
+    reader_ids = {member['DBInstanceIdentifier'] for member in members if not member['IsClusterWriter']}
+    instances = rds_client.describe_db_instances(
+        Filters=[{"Name": "db-cluster-id", "Values": [cluster_id]}])['DBInstances']
+    return [ReaderEndpoint(instance['DBInstanceIdentifier'], instance['Endpoint']['Address'],
+                           instance['AvailabilityZone'])
+            for instance in instances
+            if instance['DBInstanceIdentifier'] in reader_ids and instance.get('Endpoint')
+            and instance['DBInstanceStatus'] == 'available']
+
+
+class ReaderRouter:
+    """
+    Routes reads over one connection pool per reader endpoint. engine() picks, among the readers whose replica lag
+    is within max_lag_ms, those in availability_zone when there are any, and of those the one with the fewest
+    connections checked out by this process; when every reader lags it returns the writer engine instead and
+    counts ReaderFallbackToWriter. With a single proxy endpoint the proxy spreads the connections and the lag
+    checked is that of the slowest reader.
+    Replica lag is read from aurora_replica_status() on the writer every interval seconds by a daemon thread,
+    and published as the ReplicaLagMax gauge; a reader with unknown lag is used.
+    The reader pools share one pool class, so checkout waits are recorded by one PoolTelemetry, and pool
+    aggregates them for PoolMonitor.
+    """
+
+    def __init__(self, endpoints: list, create_engine, get_writer_engine, availability_zone: str, metrics,
+                 logger: logging.Logger, extra: dict = None, max_lag_ms: float = 1000, interval: float = 5.0,
+                 track_each_reader: bool = True):
+        self.endpoints = endpoints
+        self.create_engine = create_engine
+        self.get_writer_engine = get_writer_engine
+        self.availability_zone = availability_zone
+        self.metrics = metrics
+        self.logger = logger
+        self.extra = extra or {}
+        self.max_lag_ms = max_lag_ms
+        self.interval = interval
+        self.track_each_reader = track_each_reader
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _engine_of(self, endpoint: ReaderEndpoint):
+        if endpoint.engine is None:
+            with self._lock:
+                if endpoint.engine is None:
+                    endpoint.engine = self.create_engine(endpoint.host)
+        return endpoint.engine
+
+    def engine(self):
+        current = [endpoint for endpoint in self.endpoints
+                   if endpoint.lag_ms is None or endpoint.lag_ms <= self.max_lag_ms]
+        if not current:
+            self.metrics.increment("ReaderFallbackToWriter")
+            return self.get_writer_engine()
+        candidates = [endpoint for endpoint in current
+                      if endpoint.availability_zone == self.availability_zone] or current
+        if len(candidates) == 1:
+            return self._engine_of(candidates[0])
+        return self._engine_of(min(candidates, key=ReaderEndpoint.in_use))
+
+    @property
+    def pool(self) -> ReaderPools:
+        return ReaderPools(self.endpoints)
+
+    def engines(self) -> list:
+        """Every reader engine created so far."""
+        return [endpoint.engine for endpoint in self.endpoints if endpoint.engine is not None]
+
+    def dispose(self) -> None:
+        """Close the idle connections of every reader pool, as Engine.dispose() does for one."""
+        for engine in self.engines():
+            engine.dispose()
+
+    def check_lag(self) -> None:
+        with self.get_writer_engine().connect() as connection:
+            lags = {server_id: lag for server_id, lag in connection.execute(REPLICA_LAG) if lag is not None}
+        if self.track_each_reader:
+            for endpoint in self.endpoints:
+                endpoint.lag_ms = lags.get(endpoint.name)
+        else:
+            for endpoint in self.endpoints:
+                endpoint.lag_ms = max(lags.values()) if lags else None
+        if lags:
+            self.metrics.gauge("ReplicaLagMax", max(lags.values()), "Milliseconds")
+
+    def start(self) -> None:
+        def run():
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.check_lag()
+                except Exception as e:
+                    self.logger.warning("Replica lag check failed: %s", e, extra=self.extra)
+
+        self._thread = threading.Thread(target=run, name="reader-router", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,72 @@
+from sqlalchemy import bindparam
+from sqlalchemy import exc
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from data_objects import Activity, Customer, Symbol
+
+
+class OrderRepository:
+    """
+    The reads of the order API, as statements built once at import with bound parameters instead of a new select()
+    per call. Executing the same statement object skips constructing it, and its SQL is compiled once per engine
+    and found in the engine's compiled cache by its cache key from then on.
+    Methods take a sync Session; the asyncio entry point calls them with AsyncSession.run_sync, so both entry
+    points send the same statements.
+    Only bound parameters vary, nothing here sets session state, so a connection through RDS Proxy is not pinned.
+    Server side prepared statements are named session state: with asyncpg, which prepares statements by default,
+    set DB_PREPARED_STATEMENT_CACHE_SIZE=0 when connecting through the proxy.
+    """
+    CUSTOMER_BY_ID = select(Customer).where(Customer.id == bindparam("customer_id"))
+    CUSTOMER_BY_FIRST_NAME = select(Customer).where(Customer.first_name == bindparam("first_name"))
+    CUSTOMERS_BY_ID = select(Customer).where(Customer.id.in_(bindparam("customer_ids", expanding=True)))
+    SYMBOL_BY_TICKER = select(Symbol).where(Symbol.ticker == bindparam("ticker"))
+    SYMBOLS_BY_TICKER = select(Symbol).where(Symbol.ticker.in_(bindparam("tickers", expanding=True)))
+    SYMBOLS = select(Symbol).limit(bindparam("limit"))
+    ACTIVITY_BY_REQUEST_ID = select(Activity).where(Activity.request_id == bindparam("request_id"))
+    ACTIVITIES_BY_REQUEST_ID = select(Activity).where(Activity.request_id.in_(bindparam("request_ids",
+                                                                                       expanding=True)))
+    # left joins each primary key predicate onto a single anchor row, so a missing customer or symbol still
+    # comes back as a row with None in its place
+    _anchor = select(literal(1).label("anchor")).subquery()
+    CUSTOMER_AND_SYMBOL = select(Customer, Symbol).select_from(_anchor) \
+        .outerjoin(Customer, Customer.id == bindparam("customer_id")) \
+        .outerjoin(Symbol, Symbol.ticker == bindparam("ticker"))
+
+    def customer(self, session: Session, customer_id) -> Customer:
+        return session.scalars(self.CUSTOMER_BY_ID, {"customer_id": int(customer_id)}).one()
+
+    def customer_by_first_name(self, session: Session, first_name: str) -> Customer:
+        return session.scalars(self.CUSTOMER_BY_FIRST_NAME, {"first_name": first_name}).one()
+
+    def customers(self, session: Session, customer_ids) -> list:
+        return list(session.scalars(self.CUSTOMERS_BY_ID, {"customer_ids": [int(i) for i in customer_ids]}))
+
+    def symbol(self, session: Session, ticker: str) -> Symbol:
+        return session.scalars(self.SYMBOL_BY_TICKER, {"ticker": ticker}).one()
+
+    def symbols(self, session: Session, tickers) -> list:
+        return list(session.scalars(self.SYMBOLS_BY_TICKER, {"tickers": list(tickers)}))
+
+    def all_symbols(self, session: Session, limit: int) -> list:
+        return list(session.scalars(self.SYMBOLS, {"limit": limit}))
+
+    def activity(self, session: Session, request_id: str):
+        """The order placed with request_id, read with the unique index, or None."""
+        return session.scalars(self.ACTIVITY_BY_REQUEST_ID, {"request_id": request_id}).one_or_none()
+
+    def activities(self, session: Session, request_ids) -> list:
+        return list(session.scalars(self.ACTIVITIES_BY_REQUEST_ID, {"request_ids": list(request_ids)}))
+
+    def customer_and_symbol(self, session: Session, customer_id, ticker: str) -> tuple:
+        """
+        The customer and the symbol with a single round trip, raises NoResultFound when either does not exist,
+        just like the separate lookups.
+        """
+        rows = session.execute(self.CUSTOMER_AND_SYMBOL, {"customer_id": int(customer_id), "ticker": ticker}).all()
+        if len(rows) > 1:
+            raise exc.MultipleResultsFound("Multiple rows were found when one was required")
+        customer_record, symbol_record = rows[0]
+        if customer_record is None or symbol_record is None:
+            raise exc.NoResultFound("No row was found when one was required")
+        return customer_record, symbol_record
@@ -0,0 +1,91 @@
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+from math import ceil, floor
+from circuitbreaker import CircuitBreaker, STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+
+
+class SharedCircuitBreaker(CircuitBreaker):
+    """
+    A CircuitBreaker whose failure count and open state live in a small memory mapped file shared by every gunicorn
+    worker of a task, so failures seen by any worker count towards one threshold and an open circuit is open for all
+    of them. Use it with @circuit(cls=SharedCircuitBreaker); state, opened and failure_count read the shared state,
+    so CircuitBreakerMonitor keeps working.
+    Updates take an exclusive flock on the file and reads a shared one. Each process opens the file itself after
+    the fork, flock does not exclude processes sharing one inherited file description.
+    """
+    STATE_DIR = os.environ.get('CIRCUIT_STATE_DIR', tempfile.gettempdir())
+    # opened at in epoch seconds, failure count, open flag; a new zero filled file is a closed circuit
+    LAYOUT = struct.Struct("<dii")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.STATE_DIR, "circuit-{}.state".format(self.name))
+
+    def _mapped(self) -> mmap.mmap:
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < self.LAYOUT.size:
+                os.ftruncate(fd, self.LAYOUT.size)
+            self._fd, self._map, self._pid = fd, mmap.mmap(fd, self.LAYOUT.size), os.getpid()
+        return self._map
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        shared_state = self._mapped()
+        fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield shared_state
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read(self) -> tuple:
+        with self._locked(False) as shared_state:
+            return self.LAYOUT.unpack_from(shared_state)
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        if exc_type and self.is_failure(exc_type, exc_value):
+            self._last_failure = exc_value
+            with self._locked(True) as shared_state:
+                opened_at, failures, is_open = self.LAYOUT.unpack_from(shared_state)
+                failures += 1
+                if failures >= self._failure_threshold:
+                    opened_at, is_open = time.time(), 1
+                self.LAYOUT.pack_into(shared_state, 0, opened_at, failures, is_open)
+        else:
+            self.reset()
+        return False
+
+    def reset(self):
+        self._last_failure = None
+        # most calls succeed on a closed circuit, skip the exclusive lock when there is nothing to reset
+        if self.LAYOUT.unpack_from(self._mapped()) == (0.0, 0, 0):
+            return
+        with self._locked(True) as shared_state:
+            self.LAYOUT.pack_into(shared_state, 0, 0.0, 0, 0)
+
+    @property
+    def state(self):
+        opened_at, _, is_open = self._read()
+        if not is_open:
+            return STATE_CLOSED
+        return STATE_HALF_OPEN if opened_at + self._recovery_timeout <= time.time() else STATE_OPEN
+
+    @property
+    def open_remaining(self):
+        remain = self._read()[0] + self._recovery_timeout - time.time()
+        return ceil(remain) if remain > 0 else floor(remain)
+
+    @property
+    def failure_count(self):
+        return self._read()[1]
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import requests
+
+
+class StartupTimings:
+    """Records how long each startup step took, in milliseconds, so slow task starts can be explained."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def timed(self, name: str, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[name] = round(seconds * 1000, 1)
+
+    def mark(self, name: str) -> None:
+        """Record the time from process start until now, for milestones such as ready or warm."""
+        self.record(name, time.monotonic() - self.started)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return dict(self.timings)
+
+
+def get_task_metadata(timeout: float = .05) -> dict:
+    """Task metadata from the ECS container metadata endpoint v4, including the AvailabilityZone."""
+    meta_data_uri = os.environ.get('ECS_CONTAINER_METADATA_URI_V4')
+    return requests.get("{}/task".format(meta_data_uri), timeout=timeout).json()
+
+
+def get_parameters(names: list) -> dict:
+    """Fetch SSM parameters in batches of ten, the GetParameters limit, instead of one GetParameter call each."""
+    ssm_client = boto3.client('ssm')
+    values = {}
+    for start in range(0, len(names), 10):
+        response = ssm_client.get_parameters(Names=names[start:start + 10])
+        if response['InvalidParameters']:
+            raise KeyError("SSM parameters not found: {}".format(response['InvalidParameters']))
+        values.update({parameter['Name']: parameter['Value'] for parameter in response['Parameters']})
+    return values
+
+
+def load_config(timings: StartupTimings, parameter_names: list) -> tuple:
+    """Fetch the task metadata and the SSM parameters concurrently, returns (task metadata, parameters by name)."""
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as executor:
+        task = executor.submit(timings.timed, "task_metadata", get_task_metadata)
+        parameters = executor.submit(timings.timed, "ssm_parameters", get_parameters, parameter_names)
+        return task.result(), parameters.result()
+
+
+def warm_up_in_background(timings: StartupTimings, steps: list, logger, extra: dict) -> threading.Thread:
+    """
+    Run (name, function) warm-up steps, such as creating database engines, on a daemon thread so the process
+    can answer load balancer health checks while they run. A failed step is logged and the rest still run,
+    anything not warmed is created on first use instead.
+    """
+
+    def run():
+        for name, func in steps:
+            try:
+                timings.timed(name, func)
+            except Exception as e:
+                logger.warning("Warm up step {} failed, it will run on first use: {}".format(name, e), extra=extra)
+        timings.mark("warm")
+        logger.info("Startup timings in ms: {}".format(timings.as_dict()), extra=extra)
+
+    thread = threading.Thread(target=run, name="startup-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.orm import Session
+from data_objects import Symbol
+from repository import OrderRepository
+
+
+class SymbolCache:
+    """
+    A bounded, thread-safe, in-process cache of Symbol rows keyed by ticker.
+    Entries expire after ttl seconds and the least recently used entry is evicted once max_size is reached.
+    The symbol table is small and mostly static, so caching it removes a reader round trip from every trade.
+    Cached symbols are detached from their session, only read their loaded attributes.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.repository = OrderRepository()
+
+    def get(self, ticker: str):
+        """Return the cached symbol for a ticker, or None when it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(ticker)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ticker)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, symbol: Symbol) -> Symbol:
+        """
+        Cache a symbol unless a newer version, by updated_on, is already cached.
+        Guards against a slow lookup overwriting a price that changed while it was in flight.
+        """
+        with self._lock:
+            entry = self._entries.get(symbol.ticker)
+            if entry is not None and entry[0].updated_on is not None and symbol.updated_on is not None \
+                    and entry[0].updated_on > symbol.updated_on:
+                return entry[0]
+            self._entries[symbol.ticker] = (symbol, time.monotonic())
+            self._entries.move_to_end(symbol.ticker)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return symbol
+
+    def invalidate(self, ticker: str) -> None:
+        with self._lock:
+            self._entries.pop(ticker, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def warm(self, session: Session) -> int:
+        """Load the whole symbol table, up to max_size rows, so the first trades do not pay for misses."""
+        symbols = self.repository.all_symbols(session, self.max_size)
+        for symbol in symbols:
+            session.expunge(symbol)
+            self.put(symbol)
+        return len(symbols)
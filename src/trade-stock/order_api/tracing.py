@@ -0,0 +1,285 @@
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+import requests
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a request. trace_id is 32 hex digits starting with the epoch seconds of the trace, so the
+    same id is valid for OTLP and, split as 1-xxxxxxxx-yyyy, for X-Ray.
+    """
+
+    def __init__(self, name: str, trace, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._started = time.perf_counter()
+        self.duration = None
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "trace_id": self.trace.trace_id, "span_id": self.span_id,
+                "parent_id": self.parent_id, "start_ns": self.start_ns, "end_ns": self.end_ns,
+                "duration_ms": round(self.duration * 1000, 3), "attributes": self.attributes, "error": self.error}
+
+
+class Trace:
+    """The spans of one request, in the order they finished."""
+
+    def __init__(self, trace_id: str = None, sampled: bool = True):
+        self.trace_id = trace_id or "{:08x}{:024x}".format(int(time.time()), random.getrandbits(96))
+        self.sampled = sampled
+        self.spans = []
+
+
+class Tracer:
+    """
+    In-process spans around the stages of a request, with no sidecar. trace() opens the root span of a request and
+    span() times a stage inside it; outside a trace span() does nothing, so instrumented code costs a context
+    variable lookup when a request is not traced.
+    A sample_rate share of requests is exported, finished traces are handed to a daemon thread that calls
+    exporter.export(traces) in batches, and traces beyond max_queue are dropped rather than slowing requests.
+    A request can also be traced only to answer a Server-Timing header, without being exported.
+    """
+
+    def __init__(self, exporter=None, sample_rate: float = 1.0, max_queue: int = 2048, batch_size: int = 64,
+                 logger: logging.Logger = None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate if exporter is not None else 0.0
+        self.batch_size = batch_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    @contextlib.contextmanager
+    def trace(self, name: str, trace_id: str = None, parent_id: str = None, sampled: bool = None, **attributes):
+        """The root span of a request, exported when the trace is sampled."""
+        root = Span(name, Trace(trace_id, self.sampled() if sampled is None else sampled), parent_id, attributes)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except Exception as e:
+            root.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            root.finish()
+            root.trace.spans.append(root)
+            if root.trace.sampled:
+                self._export(root.trace)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        child = Span(name, parent.trace, parent.span_id, attributes)
+        token = _current_span.set(child)
+        try:
+            yield child
+        except Exception as e:
+            child.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            child.finish()
+            parent.trace.spans.append(child)
+
+    @staticmethod
+    def current():
+        """The innermost open span of this request, or None outside a trace."""
+        return _current_span.get()
+
+    def _export(self, trace: Trace) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self) -> None:
+        def run():
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.exporter.export(batch)
+                except Exception as e:
+                    self.logger.warning("Span export failed: %s", e)
+
+        self._thread = threading.Thread(target=run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+
+def server_timing(trace: Trace, root: Span) -> str:
+    """A Server-Timing header value with the finished stages of a trace and the total so far, in milliseconds."""
+    entries = ["{};dur={:.1f}".format(span.name, span.duration * 1000) for span in trace.spans if span is not root]
+    entries.append("total;dur={:.1f}".format((time.perf_counter() - root._started) * 1000))
+    return ", ".join(entries)
+
+
+def parse_traceparent(header: str) -> tuple:
+    """The trace id, parent span id and sampled flag of a W3C traceparent header, or Nones when it is not valid."""
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+class LogExporter:
+    """Writes each trace as one JSON log record with its spans."""
+
+    def __init__(self, logger: logging.Logger, extra: dict = None):
+        self.logger = logger
+        self.extra = extra or {}
+
+    def export(self, traces: list) -> None:
+        for trace in traces:
+            self.logger.info("trace %s", trace.trace_id,
+                             extra=dict(self.extra, spans=[span.as_dict() for span in trace.spans]))
+
+
+class OtlpHttpExporter:
+    """Posts traces as OTLP/HTTP JSON to a collector, such as the ADOT or OpenTelemetry collector on the task."""
+
+    def __init__(self, endpoint: str = "http://localhost:4318/v1/traces", service_name: str = "trade-order",
+                 timeout: float = 1.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    @staticmethod
+    def _span(span: Span) -> dict:
+        otlp_span = {"traceId": span.trace.trace_id, "spanId": span.span_id, "name": span.name,
+                     "kind": 2 if span.parent_id is None else 1,
+                     "startTimeUnixNano": str(span.start_ns), "endTimeUnixNano": str(span.end_ns),
+                     "attributes": [{"key": key, "value": {"stringValue": str(value)}}
+                                    for key, value in span.attributes.items()],
+                     "status": {"code": 2, "message": span.error} if span.error else {"code": 0}}
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, traces: list) -> None:
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "trade"},
+                            "spans": [self._span(span) for trace in traces for span in trace.spans]}]}]}
+        self.session.post(self.endpoint, json=body, timeout=self.timeout).raise_for_status()
+
+
+class XRayUdpExporter:
+    """
+    Sends each trace as an X-Ray segment, with a subsegment per stage, to the X-Ray daemon over UDP.
+    https://docs.aws.amazon.com/xray/latest/devguide/xray-api-sendingdata.html
+    """
+    HEADER = b'{"format": "json", "version": 1}\n'
+
+    def __init__(self, address: tuple = ("127.0.0.1", 2000), service_name: str = "trade-order"):
+        self.address = address
+        self.service_name = service_name
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def segment(self, trace: Trace) -> dict:
+        trace_id = "1-{}-{}".format(trace.trace_id[:8], trace.trace_id[8:])
+        documents = {span.span_id: {"name": span.name, "id": span.span_id, "start_time": span.start_ns / 1e9,
+                                    "end_time": span.end_ns / 1e9, "annotations": span.attributes,
+                                    "fault": span.error is not None}
+                     for span in trace.spans}
+        # the root span finishes last, every other span is a subsegment of its parent
+        root = documents[trace.spans[-1].span_id]
+        for span in trace.spans[:-1]:
+            documents[span.parent_id].setdefault("subsegments", []).append(documents[span.span_id])
+        root.update({"name": self.service_name, "trace_id": trace_id})
+        if trace.spans[-1].parent_id:
+            root["parent_id"] = trace.spans[-1].parent_id
+        return root
+
+    def export(self, traces: list) -> None:
+        for trace in traces:
+            self.socket.sendto(self.HEADER + json.dumps(self.segment(trace)).encode("utf-8"), self.address)
+
+
+def exporter_from(name: str, logger: logging.Logger, extra: dict = None, endpoint: str = None,
+                  service_name: str = "trade-order"):
+    """The exporter for TRACE_EXPORTER: log, otlp, xray, or None for anything else."""
+    if name == "log":
+        return LogExporter(logger, extra)
+    if name == "otlp":
+        return OtlpHttpExporter(endpoint or "http://localhost:4318/v1/traces", service_name)
+    if name == "xray":
+        host, _, port = (endpoint or "127.0.0.1:2000").partition(":")
+        return XRayUdpExporter((host, int(port or 2000)), service_name)
+    return None
+
+
+class TracingMiddleware:
+    """
+    WSGI middleware that runs each request in paths inside a trace, continuing the trace of a W3C traceparent
+    header. A request with an X-Server-Timing header is traced even when it is not sampled, and its response
+    gets a Server-Timing header with the duration of each stage.
+    """
+
+    def __init__(self, app, tracer: Tracer, paths: set, server_timing_enabled: bool = True):
+        self.app = app
+        self.tracer = tracer
+        self.paths = paths
+        self.server_timing_enabled = server_timing_enabled
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO")
+        timing = self.server_timing_enabled and "HTTP_X_SERVER_TIMING" in environ
+        if path not in self.paths or not (timing or self.tracer.sample_rate > 0):
+            return self.app(environ, start_response)
+        trace_id, parent_id, parent_sampled = parse_traceparent(environ.get("HTTP_TRACEPARENT"))
+        sampled = self.tracer.sampled() if parent_sampled is None else parent_sampled and self.tracer.sample_rate > 0
+        if not (sampled or timing):
+            return self.app(environ, start_response)
+
+        with self.tracer.trace("{} {}".format(environ.get("REQUEST_METHOD"), path), trace_id, parent_id, sampled,
+                               path=path) as root:
+            def timed_start_response(status, headers, exc_info=None):
+                root.attributes["status"] = status.split(" ", 1)[0]
+                if timing:
+                    headers = list(headers) + [("Server-Timing", server_timing(root.trace, root))]
+                return start_response(status, headers, exc_info)
+
+            # the body is produced before the trace ends, so every stage is timed, and the app's iterable is closed
+            # as PEP 3333 requires, which runs Flask's teardown and call_on_close callbacks
+            body = self.app(environ, timed_start_response)
+            try:
+                return list(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
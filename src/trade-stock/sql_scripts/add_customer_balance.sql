@@ -0,0 +1,2 @@
+-- adds the customer cash balance to a database created before it was part of schema.sql
+ALTER TABLE customer ADD COLUMN IF NOT EXISTS balance numeric DEFAULT 100000 NOT NULL CHECK (balance >= 0);
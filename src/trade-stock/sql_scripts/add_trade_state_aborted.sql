@@ -0,0 +1,2 @@
+-- adds the aborted order state to a database created before it was part of schema.sql
+ALTER TYPE trade_state ADD VALUE IF NOT EXISTS 'aborted';
@@ -1,10 +1,11 @@
-CREATE TYPE trade_state AS ENUM ('submitted', 'pending', 'rejected', 'filled');
+CREATE TYPE trade_state AS ENUM ('submitted', 'pending', 'rejected', 'filled', 'aborted');
 CREATE TYPE transaction_type AS ENUM ('buy', 'sell');
 
 CREATE TABLE customer (
     id serial PRIMARY KEY,
     first_name VARCHAR ( 250 ) NOT NULL,
     last_name VARCHAR ( 250 ) NOT NULL,
+    balance numeric DEFAULT 100000 NOT NULL CHECK (balance >= 0),
     created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
     updated_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
 );
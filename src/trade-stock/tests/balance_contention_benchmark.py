@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "order_api"))
+from data_objects import Base, Customer  # noqa: E402
+from balances import CustomerLedger  # noqa: E402
+
+parser = argparse.ArgumentParser(prog="Balance Contention Benchmark",
+                                 description='''Place many buy orders for a few customers from concurrent threads and
+check that no customer is oversold. Compares the CustomerLedger reservation, one UPDATE ... WHERE balance >= cost
+RETURNING, with reading the balance and writing it back, which loses updates under contention.''',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument("--db-url", help="SQLAlchemy database URL, defaults to a temporary SQLite file",
+                    default=None)
+parser.add_argument("--customers", help="customers the orders are spread over", type=int, default=3)
+parser.add_argument("--orders", help="orders to place", type=int, default=2000)
+parser.add_argument("--threads", help="concurrent order threads", type=int, default=16)
+parser.add_argument("--balance", help="starting balance of each customer", type=float, default=1000)
+parser.add_argument("--cost", help="cost of each order", type=float, default=7)
+parser.add_argument("--latency", help="seconds between reading and writing a balance in read-then-write, "
+                                      "a stand-in for the network round trip", type=float, default=.001)
+
+
+def ledger_order(engine, ledger: CustomerLedger, customer_id: int, cost: float, latency: float) -> bool:
+    with Session(engine) as session:
+        return ledger.reserve(session, customer_id, cost)
+
+
+def read_then_write_order(engine, ledger: CustomerLedger, customer_id: int, cost: float, latency: float) -> bool:
+    with Session(engine) as session:
+        balance = session.scalars(select(Customer.balance).where(Customer.id == customer_id)).one()
+        session.commit()
+        if balance < cost:
+            return False
+        time.sleep(latency)
+        session.execute(update(Customer).where(Customer.id == customer_id).values(balance=balance - cost))
+        session.commit()
+        return True
+
+
+def reset(engine, customers: int, balance: float) -> None:
+    now = datetime.now()
+    with Session(engine) as session:
+        session.query(Customer).delete()
+        session.add_all([Customer(id=i, first_name="kevin", last_name="bench", balance=balance, created_on=now,
+                                  updated_on=now) for i in range(1, customers + 1)])
+        session.commit()
+
+
+def main():
+    args = parser.parse_args()
+    db_url = args.db_url or "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "balances.db"))
+    connect_args = {"check_same_thread": False, "timeout": 30} if db_url.startswith("sqlite") else {}
+    engine = create_engine(db_url, pool_size=args.threads, connect_args=connect_args)
+    Base.metadata.create_all(engine)
+
+    print("{:<16}{:>10}{:>10}{:>14}{:>14}{:>12}".format("flow", "accepted", "rejected", "sold", "debited",
+                                                         "orders/s"))
+    for name, flow in (("ledger", ledger_order), ("read then write", read_then_write_order)):
+        reset(engine, args.customers, args.balance)
+        ledger = CustomerLedger()
+        accepted = []
+        lock = threading.Lock()
+
+        def place(n):
+            if flow(engine, ledger, n % args.customers + 1, args.cost, args.latency):
+                with lock:
+                    accepted.append(n)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(place, range(args.orders)))
+        elapsed = time.perf_counter() - start
+        with Session(engine) as session:
+            remaining = sum(session.scalars(select(Customer.balance)))
+        # sold is what accepted orders cost, debited is what actually left the balances; they differ when
+        # concurrent writes overwrite each other
+        print("{:<16}{:>10}{:>10}{:>14.2f}{:>14.2f}{:>12.0f}".format(
+            name, len(accepted), args.orders - len(accepted), len(accepted) * args.cost,
+            args.customers * args.balance - remaining, args.orders / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import queue
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from argparse import RawTextHelpFormatter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import requests
+
+parser = argparse.ArgumentParser(prog="Gunicorn Profile Benchmark",
+                                 description='''Run each gunicorn profile of ../order_api/gunicorn.conf.py in front
+of a stand-in order app, whose /trade/ makes the order API's round trips: a lookup, an insert, a confirms call and an update.
+The database is a local TCP server that answers each round trip after --db-ms with one thread per connection,
+as Postgres runs a backend per connection, and confirms is a local HTTP server that answers after --confirms-ms.
+Each process has a pool of --pool-size database connections.
+
+python gunicorn_profile_benchmark.py --cpus 1 --memory-mb 2048 --profile sync --profile gthread --preload''',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument("--profile", help="gunicorn profile to run, repeat for each, default all", action="append",
+                    choices=["sync", "gthread", "gevent"])
+parser.add_argument("--preload", help="also run each profile with GUNICORN_PRELOAD", action="store_true")
+parser.add_argument("--cpus", help="CPUs to size for instead of the cgroup limit", type=float)
+parser.add_argument("--memory-mb", help="MiB of memory to size for instead of the cgroup limit", type=int)
+parser.add_argument("--concurrency", help="orders in flight", type=int, default=32)
+parser.add_argument("--duration", help="seconds to run each profile", type=float, default=10)
+parser.add_argument("--warm-up", help="seconds of load before measuring, so every worker has its pool",
+                    type=float, default=2)
+parser.add_argument("--db-ms", help="milliseconds per database round trip", type=float, default=2)
+parser.add_argument("--confirms-ms", help="milliseconds per confirms call", type=float, default=100)
+parser.add_argument("--pool-size", help="database connections per worker process", type=int, default=10)
+parser.add_argument("--port", help="port gunicorn binds to", type=int, default=8090)
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "order_api", "gunicorn.conf.py")
+
+
+class StandInDatabase(socketserver.ThreadingTCPServer):
+    """Answers every line after delay seconds, each connection is served by its own thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+        class Backend(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                for _ in self.rfile:
+                    time.sleep(delay)
+                    self.wfile.write(b"ok\n")
+
+        super().__init__(("127.0.0.1", 0), Backend)
+
+
+class StandInConfirms(ThreadingHTTPServer):
+    """Confirms every trade after delay seconds."""
+    daemon_threads = True
+
+    def __init__(self, delay: float):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header("Content-Length", "15")
+                self.end_headers()
+                self.wfile.write(b"Trade Confirmed")
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+
+# the stand-in order app, loaded by gunicorn in each worker as gunicorn_profile_benchmark:app
+_pool, _confirms_session, _pid = None, None, None
+_lock = threading.Lock()
+
+
+def _resources():
+    """The connection pool and confirms session of this process, created on first use after a fork."""
+    global _pool, _confirms_session, _pid
+    with _lock:
+        if _pid != os.getpid():
+            pool = queue.Queue()
+            host, port = os.environ["STANDIN_DATABASE"].split(":")
+            for _ in range(int(os.environ.get("STANDIN_POOL_SIZE", "10"))):
+                connection = socket.create_connection((host, int(port)))
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                pool.put((connection, connection.makefile("rb")))
+            _pool, _confirms_session, _pid = pool, requests.Session(), os.getpid()
+    return _pool, _confirms_session
+
+
+def post_fork() -> None:
+    """Called by gunicorn.conf.py in each worker of a preloaded app, as order_api.post_fork is."""
+    _resources()
+
+
+def app(environ, start_response):
+    if environ["PATH_INFO"] != "/trade/":
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"OK"]
+    order = json.loads(environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0)))
+    pool, confirms_session = _resources()
+    connection, reader = pool.get(timeout=1)
+    try:
+        for statement in (b"lookup\n", b"insert\n"):
+            connection.sendall(statement)
+            reader.readline()
+        confirms_session.post(os.environ["STANDIN_CONFIRMS"], json=order, timeout=1).raise_for_status()
+        connection.sendall(b"update\n")
+        reader.readline()
+    finally:
+        pool.put((connection, reader))
+    body = json.dumps(dict(order, status="filled", pid=os.getpid())).encode("utf-8")
+    start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def percentile(latencies: list, p: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+async def run_load(url: str, concurrency: int, duration: float) -> dict:
+    latencies, statuses, pids = [], {}, set()
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=10) as client:
+        async def worker():
+            while time.monotonic() < deadline:
+                order = {"request_id": str(uuid.uuid4()), "customer_id": "1", "ticker": "AMZN",
+                         "transaction_type": "buy", "current_price": "10", "share_count": "1"}
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/trade/", json=order)
+                    outcome = response.status_code
+                    if outcome == 200:
+                        pids.add(response.json()["pid"])
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[outcome] = statuses.get(outcome, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.monotonic() - started
+    latencies.sort()
+    return {"requests": len(latencies), "rps": len(latencies) / elapsed, "p50": percentile(latencies, .5),
+            "p99": percentile(latencies, .99), "workers": len(pids), "statuses": statuses}
+
+
+def start_gunicorn(args, profile: str, preload: bool, database: str, confirms: str, metrics_dir: str):
+    env = dict(os.environ, GUNICORN_PROFILE=profile, GUNICORN_PRELOAD=str(preload).lower(),
+               PROMETHEUS_MULTIPROC_DIR=metrics_dir, STANDIN_DATABASE=database, STANDIN_CONFIRMS=confirms,
+               STANDIN_POOL_SIZE=str(args.pool_size))
+    if args.cpus:
+        env["GUNICORN_CPUS"] = str(args.cpus)
+    if args.memory_mb:
+        env["GUNICORN_MEMORY_MB"] = str(args.memory_mb)
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", CONFIG, "--bind",
+                               "127.0.0.1:{}".format(args.port), "--timeout", "2", "gunicorn_profile_benchmark:app"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get("http://127.0.0.1:{}/".format(args.port), timeout=1)
+            return server
+        except requests.ConnectionError:
+            if server.poll() is not None:
+                raise RuntimeError("gunicorn exited: {}".format(server.stderr.read()))
+            time.sleep(.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def stop_gunicorn(server) -> str:
+    """Stop gunicorn and return its profile line."""
+    server.terminate()
+    _, log = server.communicate(timeout=30)
+    return next((line.split("Profile ", 1)[1] for line in log.splitlines() if "Profile " in line), "")
+
+
+def main():
+    args = parser.parse_args()
+    profiles = args.profile or ["sync", "gthread", "gevent"]
+    if any(importlib.util.find_spec(module) is None for module in ("gevent", "psycogreen", "psycopg2")):
+        print("gevent, psycogreen or psycopg2 is not installed, skipping the gevent profile")
+        profiles = [profile for profile in profiles if profile != "gevent"]
+
+    database = StandInDatabase(args.db_ms / 1000)
+    confirms = StandInConfirms(args.confirms_ms / 1000)
+    for stand_in in (database, confirms):
+        threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+    database_address = "127.0.0.1:{}".format(database.server_address[1])
+    confirms_url = "http://127.0.0.1:{}/confirm-trade/".format(confirms.server_address[1])
+
+    print("{:<18}{:>10}{:>10}{:>10}{:>10}{:>9}  {}".format("profile", "requests", "req/s", "p50 ms", "p99 ms",
+                                                           "workers", "outcomes"))
+    for profile in profiles:
+        for preload in ((False, True) if args.preload and profile != "gevent" else (False,)):
+            with tempfile.TemporaryDirectory() as metrics_dir:
+                server = start_gunicorn(args, profile, preload, database_address, confirms_url, metrics_dir)
+                url = "http://127.0.0.1:{}".format(args.port)
+                try:
+                    asyncio.run(run_load(url, args.concurrency, args.warm_up))
+                    result = asyncio.run(run_load(url, args.concurrency, args.duration))
+                finally:
+                    sizing = stop_gunicorn(server)
+            name = profile + (" preload" if preload else "")
+            print("{:<18}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>9}  {}  {}".format(
+                name, result["requests"], result["rps"], result["p50"] * 1000, result["p99"] * 1000,
+                result["workers"], result["statuses"], sizing))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from argparse import RawTextHelpFormatter
+from datetime import datetime
+from sqlalchemy import create_engine, select, literal
+from sqlalchemy.orm import Session
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "order_api"))
+from data_objects import Base, Customer, Symbol  # noqa: E402
+from repository import OrderRepository  # noqa: E402
+
+parser = argparse.ArgumentParser(prog="Lookup QPS Benchmark",
+                                 description='''Queries per second of each order API lookup from one thread, building a
+new select() per call as the order API did before, and with the prebuilt OrderRepository statements.
+Against a remote database the round trip dominates both; run against SQLite to see the client side cost.''',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument("--db-url", help="SQLAlchemy database URL, defaults to a temporary SQLite file",
+                    default=None)
+parser.add_argument("--seconds", help="seconds to run each lookup", type=float, default=2)
+parser.add_argument("--rows", help="customers and symbols to seed", type=int, default=100)
+parser.add_argument("--batch", help="ids per IN lookup", type=int, default=10)
+
+
+def inline_lookups(batch: int) -> dict:
+    def customer_and_symbol(session, n):
+        anchor = select(literal(1).label("anchor")).subquery()
+        statement = select(Customer, Symbol).select_from(anchor) \
+            .outerjoin(Customer, Customer.id == n) \
+            .outerjoin(Symbol, Symbol.ticker == "T{}".format(n))
+        return session.execute(statement).all()
+
+    return {
+        "customer": lambda session, n: session.scalars(select(Customer).where(Customer.id == n)).one(),
+        "symbol": lambda session, n: session.scalars(select(Symbol).where(Symbol.ticker == "T{}".format(n))).one(),
+        "customer_and_symbol": customer_and_symbol,
+        "customers": lambda session, n: list(session.scalars(
+            select(Customer).where(Customer.id.in_(range(n, n + batch))))),
+    }
+
+
+def repository_lookups(batch: int) -> dict:
+    repository = OrderRepository()
+    return {
+        "customer": lambda session, n: repository.customer(session, n),
+        "symbol": lambda session, n: repository.symbol(session, "T{}".format(n)),
+        "customer_and_symbol": lambda session, n: repository.customer_and_symbol(session, n, "T{}".format(n)),
+        "customers": lambda session, n: repository.customers(session, range(n, n + batch)),
+    }
+
+
+def seed(engine, rows: int) -> None:
+    now = datetime.now()
+    with Session(engine) as session:
+        session.query(Customer).delete()
+        session.query(Symbol).delete()
+        session.add_all([Customer(id=i, first_name="kevin", last_name="bench", balance=100000, created_on=now,
+                                  updated_on=now) for i in range(1, rows + 1)])
+        session.add_all([Symbol(id=i, ticker="T{}".format(i), open=1, high=1, low=1, close=1, volume=1,
+                                created_on=now, updated_on=now) for i in range(1, rows + 1)])
+        session.commit()
+
+
+def qps(engine, lookup, rows: int, batch: int, seconds: float) -> float:
+    calls = 0
+    with Session(engine) as session:
+        deadline = time.perf_counter() + seconds
+        start = time.perf_counter()
+        while time.perf_counter() < deadline:
+            lookup(session, calls % (rows - batch) + 1)
+            session.expunge_all()
+            calls += 1
+        return calls / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    db_url = args.db_url or "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "lookups.db"))
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    seed(engine, args.rows)
+
+    before = inline_lookups(args.batch)
+    after = repository_lookups(args.batch)
+    print("{:<22}{:>14}{:>14}{:>10}".format("lookup", "inline q/s", "prebuilt q/s", "change"))
+    for name in before:
+        inline_qps = qps(engine, before[name], args.rows, args.batch, args.seconds)
+        prebuilt_qps = qps(engine, after[name], args.rows, args.batch, args.seconds)
+        print("{:<22}{:>14.0f}{:>14.0f}{:>+9.0f}%".format(name, inline_qps, prebuilt_qps,
+                                                         (prebuilt_qps / inline_qps - 1) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from argparse import RawTextHelpFormatter
+import httpx
+
+parser = argparse.ArgumentParser(prog="Order API Throughput Benchmark",
+                                 description='''Drive /trade/ on one or more order API deployments side by side,
+for example the gunicorn/Flask service and the uvicorn/ASGI service, and report throughput and latency.
+
+python order_api_throughput_benchmark.py --target sync=http://localhost:8080 --target async=http://localhost:8081''',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument("--target", help="name=url of an order API, repeat for each deployment", action="append",
+                    required=True)
+parser.add_argument("--concurrency", help="orders in flight per target", type=int, default=64)
+parser.add_argument("--duration", help="seconds to run against each target", type=float, default=30)
+parser.add_argument("--request", help="trade request template", default="trade_request.json")
+parser.add_argument("--ticker", help="ticker to order, overrides the template")
+
+
+def percentile(latencies: list, p: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+async def run_target(url: str, template: dict, concurrency: int, duration: float) -> dict:
+    latencies, statuses = [], {}
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=10) as client:
+        async def worker():
+            while time.monotonic() < deadline:
+                order = dict(template, request_id=str(uuid.uuid4()))
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/trade/", json=order)
+                    outcome = response.json().get("status", response.status_code) \
+                        if response.status_code == 200 else response.status_code
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[outcome] = statuses.get(outcome, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.monotonic() - started
+    latencies.sort()
+    return {"requests": len(latencies), "rps": len(latencies) / elapsed, "p50": percentile(latencies, .5),
+            "p99": percentile(latencies, .99), "statuses": statuses}
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.request) as f:
+        template = json.load(f)
+    template.setdefault("ticker", template.get("symbol_ticker"))
+    if args.ticker:
+        template["ticker"] = args.ticker
+
+    print("{:<10}{:>10}{:>10}{:>10}{:>10}  {}".format("target", "requests", "req/s", "p50 ms", "p99 ms", "outcomes"))
+    for target in args.target:
+        name, url = target.split("=", 1)
+        result = asyncio.run(run_target(url, template, args.concurrency, args.duration))
+        print("{:<10}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}  {}".format(name, result["requests"], result["rps"],
+                                                                   result["p50"] * 1000, result["p99"] * 1000,
+                                                                   result["statuses"]))
+
+
+if __name__ == "__main__":
+    main()
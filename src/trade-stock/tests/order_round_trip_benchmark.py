@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+import uuid
+from argparse import RawTextHelpFormatter
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "order_api"))
+from data_objects import Base, Customer, Symbol, Activity, TradeState, TransactionType  # noqa: E402
+from order_state import OrderStateEngine  # noqa: E402
+
+parser = argparse.ArgumentParser(prog="Order Round Trip Benchmark",
+                                 description='''Count writer round trips per order for the legacy per-status commits
+and the OrderStateEngine. A round trip is a BEGIN, a statement or a COMMIT sent to the database.''',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument("--db-url", help="SQLAlchemy database URL, defaults to an in-memory SQLite database",
+                    default="sqlite://")
+parser.add_argument("--orders", help="orders per outcome", type=int, default=100)
+
+
+class RoundTripCounter:
+    """Counts the statements and, outside autocommit, the BEGIN and COMMIT messages an engine sends."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._statement)
+        event.listen(engine, "begin", self._transaction)
+        event.listen(engine, "commit", self._transaction)
+
+    def _statement(self, *args):
+        self.count += 1
+
+    def _transaction(self, conn):
+        if conn.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+            self.count += 1
+
+
+def new_activity(customer: Customer, symbol: Symbol, status: TradeState) -> Activity:
+    return Activity(customer_id=customer.id, symbol_ticker=symbol.id, status=status, type=TransactionType.buy,
+                    share_count=1, current_price=symbol.close, request_id=str(uuid.uuid4()))
+
+
+def legacy_order(engine, customer, symbol, outcome: TradeState) -> None:
+    """The per-status commits trade() made before the OrderStateEngine."""
+    with Session(engine) as session:
+        session.expire_on_commit = False
+        activity = new_activity(customer, symbol, TradeState.submitted)
+        session.add(activity)
+        session.commit()
+        if outcome == TradeState.filled:
+            activity.status = TradeState.pending
+            session.commit()
+        activity.status = outcome
+        session.commit()
+
+
+def state_engine_order(engine, customer, symbol, outcome: TradeState) -> None:
+    states = OrderStateEngine()
+    with Session(engine) as session:
+        initial_state = TradeState.pending if outcome == TradeState.filled else outcome
+        activity = states.open(session, new_activity(customer, symbol, initial_state))
+        if initial_state == TradeState.pending:
+            states.transition(session, activity, outcome)
+
+
+def main():
+    args = parser.parse_args()
+    engine = create_engine(args.db_url)
+    Base.metadata.create_all(engine)
+    now = datetime.now()
+    with Session(engine) as session:
+        session.expire_on_commit = False
+        customer = Customer(id=1, first_name="kevin", last_name="bench", balance=100000, created_on=now,
+                            updated_on=now)
+        symbol = Symbol(id=1, ticker="BNCH", open=1, high=1, low=1, close=1, volume=1, created_on=now, updated_on=now)
+        session.add_all([customer, symbol])
+        session.commit()
+
+    counter = RoundTripCounter(engine)
+    print("{:<14}{:<12}{:>16}{:>16}".format("flow", "outcome", "round trips", "ms per order"))
+    for name, flow in (("legacy", legacy_order), ("state engine", state_engine_order)):
+        for outcome in (TradeState.filled, TradeState.rejected, TradeState.aborted):
+            counter.count = 0
+            start = time.perf_counter()
+            for _ in range(args.orders):
+                flow(engine, customer, symbol, outcome)
+            elapsed = time.perf_counter() - start
+            print("{:<14}{:<12}{:>16.1f}{:>16.3f}".format(name, outcome.value, counter.count / args.orders,
+                                                          elapsed * 1000 / args.orders))
+
+
+if __name__ == "__main__":
+    main()
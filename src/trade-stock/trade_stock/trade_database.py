@@ -109,8 +109,14 @@ class TradeDatabaseStack(cdk.Stack):
                                   role_name=cdk.PhysicalName.GENERATE_IF_NEEDED,
                                   assumed_by=iam.ServicePrincipal('ecs-tasks.amazonaws.com'))
         self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"], actions=["secretsmanager:ListSecrets"]))
-        self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"], actions=["ssm:GetParameter"]))
+        self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"],
+                                                         actions=["ssm:GetParameter", "ssm:GetParameters"]))
         self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"], actions=["cloudwatch:PutMetricData"]))
+        # order api connection pools are sized by the number of running tasks in the service
+        self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"], actions=["ecs:DescribeServices"]))
+        # reads are routed over the reader instances of the cluster, looked up at startup
+        self.task_role.add_to_policy(iam.PolicyStatement(resources=["*"],
+                                                         actions=["rds:DescribeDBClusters", "rds:DescribeDBInstances"]))
         order_api_secret.grant_read(self.task_role)
         proxy.grant_connect(self.task_role, order_api_user_name)
         self.cluster.connections.allow_from(ec2.Peer.ipv4(vpc.vpc_cidr_block), ec2.Port.tcp(5432))